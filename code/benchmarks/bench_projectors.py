@@ -0,0 +1,178 @@
+# convergence of the sliced Wasserstein flow for the families of projectors
+#
+# usage, from the code directory:
+#   python benchmarks/bench_projectors.py --num_thetas 10 30 100 --dim 100 \
+#       --output bench_projectors.json
+#
+# The flow is run on the same GMM data and from the same particles with
+# each family of projection.PROJECTORS. After each epoch, the sliced
+# Wasserstein distance between the particles and the data is measured on
+# the same set of i.i.d. directions for all families, so that the loss is
+# comparable across them. The time spent in this evaluation is not counted,
+# so that the results give the distance as a function of the wall-clock
+# time of the flow itself, building the projectors included. For each run,
+# the time it takes to reach the final distance of the gaussian projectors
+# with the same number of thetas is reported.
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import platform
+from types import SimpleNamespace
+import numpy as np
+import torch
+from torchpercentile import Percentile
+import qsketch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+import generate_toydata  # noqa: E402
+import sketches  # noqa: E402
+import projection  # noqa: E402
+from swf import swf  # noqa: E402
+from bench_swf import RandomProjectors, synchronize  # noqa: E402
+
+
+class SlicedWasserstein:
+    """ sliced Wasserstein distance to the data, along fixed thetas. The
+    quantiles of the data are computed once for all."""
+
+    def __init__(self, data, thetas, percentiles):
+        self.thetas = thetas
+        self.percentiles = percentiles
+        self.data_qf = Percentile()(torch.mm(data, thetas.t()), percentiles)
+
+    def __call__(self, particles):
+        particles_qf = Percentile()(torch.mm(particles, self.thetas.t()),
+                                    self.percentiles)
+        return float(torch.sqrt(((particles_qf - self.data_qf)**2).mean()))
+
+
+def run(family, data, particles, num_thetas, num_sketches, percentiles,
+        num_epochs, evaluation, device):
+    """ runs the flow with a family of projectors. returns the time and the
+    distance of the particles to the data after each epoch"""
+    synchronize(device)
+    start = time.perf_counter()
+    modules = qsketch.ModulesDataset(projection.PROJECTORS[family],
+                                     input_shape=(data.shape[1],),
+                                     num_projections=num_thetas)
+    projectors = projection.ProjectorRegistry(modules, device=device)
+    ids = list(range(num_sketches))
+    target_qf = torch.stack([
+        Percentile()(projectors.forward(data, [id]), percentiles).t()
+        for id in ids])
+    bank = sketches.SketchBank.from_sketches(target_qf, ids, device=device)
+    sketcher = SimpleNamespace(queue=None, percentiles=percentiles,
+                               shared_data={'num_epochs': 1,
+                                            'num_sketches': num_sketches})
+    times = []
+    distances = []
+    skipped = [0]
+
+    def record(vars, epoch):
+        synchronize(device)
+        now = time.perf_counter()
+        times.append(now - start - skipped[0])
+        distances.append(evaluation(vars['particles']['train']))
+        skipped[0] += time.perf_counter() - now
+
+    swf(particles.clone(), None, sketcher, projectors, stepsize=1,
+        regularization=0, num_epochs=num_epochs, device_str=device.type,
+        plot_function=record, fixed_sketches=bank)
+    return (times, distances)
+
+
+def time_to_reach(times, distances, target):
+    """ first time at which the distance gets below target, or None"""
+    for (elapsed, distance) in zip(times, distances):
+        if distance <= target:
+            return elapsed
+    return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Convergence of the sliced Wasserstein flow for the '
+                    'families of projectors')
+    parser.add_argument("--families", nargs='+',
+                        default=sorted(projection.PROJECTORS.keys()),
+                        choices=sorted(projection.PROJECTORS.keys()),
+                        help="families of projectors to compare")
+    parser.add_argument("--num_thetas", nargs='+', type=int,
+                        default=[10, 30, 100],
+                        help="numbers of projections per sketch")
+    parser.add_argument("--dim", nargs='+', type=int, default=[2, 100],
+                        help="dimensions of the data")
+    parser.add_argument("--num_samples", type=int, default=3000,
+                        help="number of particles")
+    parser.add_argument("--num_quantiles", type=int, default=100,
+                        help="number of quantiles of the sketches")
+    parser.add_argument("--num_sketches", type=int, default=1,
+                        help="number of sketches")
+    parser.add_argument("--num_epochs", type=int, default=50,
+                        help="number of epochs of each flow")
+    parser.add_argument("--num_data", type=int, default=20000,
+                        help="number of samples of the target data")
+    parser.add_argument("--num_components", type=int, default=10,
+                        help="number of components of the GMMs")
+    parser.add_argument("--num_eval_thetas", type=int, default=500,
+                        help="number of i.i.d. directions for measuring the "
+                             "sliced Wasserstein distance")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed for the data and the particles")
+    parser.add_argument("--output", default='bench_projectors.json',
+                        help="JSON file for the results")
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    percentiles = torch.linspace(0, 100, args.num_quantiles, device=device)
+    eval_percentiles = torch.linspace(0, 100, 200, device=device)
+    results = []
+    for dim in args.dim:
+        np.random.seed(args.seed)
+        torch.manual_seed(args.seed)
+        params = generate_toydata.draw_GMM_parameters(
+            dim, args.num_components, args.seed)
+        (X, _) = generate_toydata.rand_GMM(params, args.num_data)
+        data = torch.from_numpy(generate_toydata.normalize(X)).view(
+            args.num_data, -1).float().to(device)
+        particles = torch.randn(args.num_samples, dim, device=device)
+        # the evaluation directions are seeded apart from the flow ones
+        evaluation = SlicedWasserstein(
+            data, RandomProjectors(dim, args.num_eval_thetas)[
+                args.seed + 2**20].weight.to(device),
+            eval_percentiles)
+
+        baseline = {}
+        grid = itertools.product(args.num_thetas, args.families)
+        for (num_thetas, family) in grid:
+            config = dict(family=family, dim=dim, num_thetas=num_thetas,
+                          num_samples=args.num_samples,
+                          num_sketches=args.num_sketches)
+            print('benchmarking', config)
+            (times, distances) = run(
+                family, data, particles, num_thetas, args.num_sketches,
+                percentiles, args.num_epochs, evaluation, device)
+            if family == 'gaussian':
+                baseline[num_thetas] = distances[-1]
+            results += [dict(config, times=times, distances=distances,
+                             final_distance=distances[-1],
+                             total_time=times[-1])]
+        # time to reach the final distance of the gaussian projectors
+        for result in results:
+            if result['dim'] == dim and result['num_thetas'] in baseline:
+                result['time_to_baseline'] = time_to_reach(
+                    result['times'], result['distances'],
+                    baseline[result['num_thetas']])
+
+    with open(args.output, 'w') as f:
+        json.dump({'settings': vars(args),
+                   'device': str(device),
+                   'torch': torch.__version__,
+                   'platform': platform.platform(),
+                   'num_threads': torch.get_num_threads(),
+                   'results': results}, f, indent=2)
+    print('results written to', args.output)
@@ -0,0 +1,213 @@
+# timings of the sliced Wasserstein flow on synthetic workloads
+#
+# usage, from the code directory:
+#   python benchmarks/bench_swf.py --num_samples 1000 10000 --dim 2 100 \
+#       --output bench.json
+#
+# The data are drawn from a GMM of generate_toydata, the projectors are
+# random and the sketches are computed directly from the data, so that
+# nothing needs to be downloaded. For each point of the grid of parameters,
+# the whole flow is timed epoch after epoch, and each stage of a step is
+# timed on its own.
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import platform
+from types import SimpleNamespace
+import numpy as np
+import torch
+from torchpercentile import Percentile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+import generate_toydata  # noqa: E402
+import engine  # noqa: E402
+import sketches  # noqa: E402
+import projection  # noqa: E402
+from swf import swf  # noqa: E402
+
+
+class RandomProjectors:
+    """ random (num_thetas, dim) projectors, seeded by their ids, served as
+    the modules of a projection.ProjectorRegistry"""
+
+    def __init__(self, dim, num_thetas):
+        self.dim = dim
+        self.num_thetas = num_thetas
+
+    def __getitem__(self, id):
+        generator = torch.Generator().manual_seed(id)
+        thetas = torch.randn(self.num_thetas, self.dim, generator=generator)
+        thetas /= thetas.norm(dim=1, keepdim=True)
+        return SimpleNamespace(weight=thetas)
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def timeit(function, device, repeats):
+    """ returns the median time of some calls to function, in seconds"""
+    times = []
+    for _ in range(repeats):
+        synchronize(device)
+        start = time.perf_counter()
+        function()
+        synchronize(device)
+        times += [time.perf_counter() - start]
+    return float(np.median(times))
+
+
+def workload(num_samples, num_thetas, num_quantiles, dim, num_sketches,
+             num_data, num_components, seed, device):
+    """ draws data from a GMM, and returns (particles, projectors, bank,
+    percentiles) with bank a sketches.SketchBank of the data"""
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    params = generate_toydata.draw_GMM_parameters(dim, num_components, seed)
+    (X, _) = generate_toydata.rand_GMM(params, num_data)
+    X = torch.from_numpy(generate_toydata.normalize(X)).view(num_data, -1)
+    X = X.to(device)
+
+    percentiles = torch.linspace(0, 100, num_quantiles, device=device)
+    projectors = projection.ProjectorRegistry(
+        RandomProjectors(dim, num_thetas), device=device)
+    ids = list(range(num_sketches))
+    thetas = projectors.stack(ids)
+    target_qf = torch.stack([
+        Percentile()(torch.mm(X, thetas[index].t()), percentiles).t()
+        for index in range(num_sketches)])
+    bank = sketches.SketchBank.from_sketches(target_qf, ids, device=device)
+    particles = torch.randn(num_samples, dim, device=device)
+    return (particles, projectors, bank, percentiles)
+
+
+def bench_stages(particles, thetas, target_qf, percentiles, repeats, device):
+    """ times each stage of one step of the flow, for the train particles
+    (exact ranks) and for the test ones (interpolated CDF)"""
+    slice_step = engine.SliceStep(percentiles)
+    (num_sketches, num_thetas, dim) = thetas.shape
+    thetas = thetas.view(-1, dim)
+    target_qf = target_qf.reshape(num_sketches * num_thetas, -1)
+    projections = slice_step.project(particles, thetas)
+    (particles_qf, transported) = slice_step.rank_transport(projections,
+                                                            target_qf)
+    reference_qf = particles_qf.clone()
+
+    def backward():
+        # backproject modifies the transported values in place
+        slice_step.backproject(transported.clone(), projections, thetas)
+
+    def rank_transport():
+        # the targets at the ranks are cached across steps: drop them, so
+        # that each call computes them as in the first step of an epoch
+        slice_step.targets = None
+        slice_step.rank_transport(projections, target_qf)
+
+    return {
+        'projection': timeit(lambda: slice_step.project(particles, thetas),
+                             device, repeats),
+        'rank_transport': timeit(rank_transport, device, repeats),
+        'percentile': timeit(lambda: Percentile()(projections, percentiles),
+                             device, repeats),
+        'interp': timeit(
+            lambda: slice_step.reference_transport(projections, target_qf,
+                                                   reference_qf),
+            device, repeats),
+        'backward': timeit(backward, device, repeats),
+        'noise': timeit(lambda: torch.randn(*particles.shape, device=device),
+                        device, repeats)}
+
+
+def bench_flow(particles, projectors, bank, percentiles, num_epochs, device,
+               **kwargs):
+    """ runs the flow with the given sketches, and returns the time of each
+    epoch and the final loss"""
+    sketcher = SimpleNamespace(queue=None, percentiles=percentiles,
+                               shared_data={'num_epochs': 1,
+                                            'num_sketches': len(bank)})
+    stamps = []
+    losses = []
+
+    def record(vars, epoch):
+        synchronize(device)
+        stamps.append(time.perf_counter())
+        if 'train' in vars['loss']:
+            losses.append(float(vars['loss']['train']))
+
+    swf(particles, None, sketcher, projectors, stepsize=1,
+        regularization=0, num_epochs=num_epochs, device_str=device.type,
+        plot_function=record, fixed_sketches=bank, **kwargs)
+    return (np.diff(stamps).tolist(), losses)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Benchmark of the sliced Wasserstein flow')
+    parser.add_argument("--num_samples", nargs='+', type=int,
+                        default=[1000, 10000],
+                        help="numbers of particles")
+    parser.add_argument("--num_thetas", nargs='+', type=int,
+                        default=[30, 100],
+                        help="numbers of projections per sketch")
+    parser.add_argument("--num_quantiles", nargs='+', type=int,
+                        default=[100],
+                        help="numbers of quantiles")
+    parser.add_argument("--dim", nargs='+', type=int, default=[2, 100],
+                        help="dimensions of the data")
+    parser.add_argument("--num_sketches", type=int, default=1,
+                        help="number of sketches")
+    parser.add_argument("--num_epochs", type=int, default=20,
+                        help="number of epochs of each flow")
+    parser.add_argument("--num_data", type=int, default=20000,
+                        help="number of samples of the target data")
+    parser.add_argument("--num_components", type=int, default=10,
+                        help="number of components of the GMMs")
+    parser.add_argument("--repeats", type=int, default=10,
+                        help="number of runs for timing each stage")
+    parser.add_argument("--num_flow_workers", type=int, default=1,
+                        help="number of processes for the flow")
+    parser.add_argument("--chunk_size", type=int,
+                        help="if provided, particles are processed by "
+                             "chunks of this size")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed for the workloads")
+    parser.add_argument("--output", default='bench_swf.json',
+                        help="JSON file for the results")
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    results = []
+    grid = itertools.product(args.num_samples, args.num_thetas,
+                             args.num_quantiles, args.dim)
+    for (num_samples, num_thetas, num_quantiles, dim) in grid:
+        config = dict(num_samples=num_samples, num_thetas=num_thetas,
+                      num_quantiles=num_quantiles, dim=dim,
+                      num_sketches=args.num_sketches)
+        print('benchmarking', config)
+        (particles, projectors, bank, percentiles) = workload(
+            num_data=args.num_data, num_components=args.num_components,
+            seed=args.seed, device=device, **config)
+        stages = bench_stages(particles, projectors.stack(bank.ids),
+                              bank.target_qf, percentiles, args.repeats,
+                              device)
+        (epochs, losses) = bench_flow(
+            particles, projectors, bank, percentiles, args.num_epochs,
+            device, num_flow_workers=args.num_flow_workers,
+            chunk_size=args.chunk_size)
+        results += [dict(config, stages=stages, epochs=epochs,
+                         median_epoch=float(np.median(epochs)),
+                         losses=losses)]
+
+    with open(args.output, 'w') as f:
+        json.dump({'settings': vars(args),
+                   'device': str(device),
+                   'torch': torch.__version__,
+                   'platform': platform.platform(),
+                   'num_threads': torch.get_num_threads(),
+                   'results': results}, f, indent=2)
+    print('results written to', args.output)
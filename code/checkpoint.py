@@ -0,0 +1,96 @@
+# checkpoints for long sliced Wasserstein flows
+import os
+import threading
+import queue
+import torch
+
+
+def add_checkpoint_arguments(parser):
+    parser.add_argument("--checkpoint",
+                        help="filename for the checkpoints of the flow. If "
+                             "not provided, no checkpoint is written.")
+    parser.add_argument("--checkpoint_every",
+                        help="Number of epochs between checkpoints",
+                        type=int,
+                        default=100)
+    parser.add_argument("--resume",
+                        help="If active, will resume the flow from the "
+                             "checkpoint file, if it exists.",
+                        action="store_true")
+    return parser
+
+
+def save(state, filename):
+    """ atomically writes a state to filename: it is first written to a
+    temporary file that then replaces the previous checkpoint."""
+    tmp_filename = filename + '.tmp'
+    torch.save(state, tmp_filename)
+    os.replace(tmp_filename, filename)
+
+
+def load(filename):
+    """ loads a checkpoint, or returns None if it doesn't exist"""
+    if not os.path.exists(filename):
+        return None
+    return torch.load(filename, map_location='cpu')
+
+
+def restore_rng(state):
+    """ sets the random generators as they were at the checkpoint"""
+    torch.set_rng_state(state['rng'])
+    if state['cuda_rng'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda_rng'])
+
+
+class Checkpointer:
+    """Periodic checkpoints of a flow, written by a background thread.
+
+    Called with the local variables of the flow, it takes a cpu snapshot
+    of the particles, the fixed sketches, the epoch, the state of the
+    integrator and of the random generators, and hands it to a thread that
+    writes it to disk, so that the flow does not wait for the write."""
+
+    def __init__(self, filename, every=100):
+        """
+        filename: string
+            file to write the checkpoints to
+        every: int
+            number of epochs between checkpoints
+        """
+        self.filename = os.path.expanduser(filename)
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.every = every
+        # only one snapshot waits for the writer at a time
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self.write, daemon=True)
+        self.thread.start()
+
+    def write(self):
+        for state in iter(self.queue.get, None):
+            save(state, self.filename)
+
+    def __call__(self, vars, epoch, force=False):
+        if not force and (self.every <= 0 or epoch % self.every):
+            return
+        sketch_bank = vars['sketch_bank']
+        state = {
+            'epoch': epoch,
+            'particles': {task: value.detach().cpu().clone()
+                          for (task, value) in vars['particles'].items()},
+            'sketches': (None if sketch_bank is None
+                         else (sketch_bank.target_qf.detach().cpu().clone(),
+                               list(sketch_bank.ids))),
+            'integrator': vars['integrator'].state_dict(),
+            'early_stopping': (None if vars['early_stopping'] is None
+                               else vars['early_stopping'].state_dict()),
+            'rng': torch.get_rng_state(),
+            'cuda_rng': (torch.cuda.get_rng_state_all()
+                         if torch.cuda.is_available() else None)}
+        self.queue.put(state)
+
+    def close(self):
+        """ waits for the pending checkpoint to be written"""
+        self.queue.put(None)
+        self.thread.join()
@@ -5,9 +5,13 @@ from torchvision import transforms as T
 from torch.utils import data
 import os
 import torch
+import numpy as np
 import random
 from PIL import Image
 
+# the file of the TOY dataset, as written by generate_toydata.py
+TOY_FILENAME = 'toy.npy'
+
 
 class CelebA(data.Dataset):
     """Dataset class for the CelebA dataset."""
@@ -61,8 +65,166 @@ class CelebA(data.Dataset):
         return self.num_images
 
 
-def load_image_dataset(dataset, data_dir="data", img_size=None, mode='train'):
-    """handles torchvision datasets and celebA"""
+class MemmapDataset(data.Dataset):
+    """Dataset whose items are the rows of a memory-mapped .npy file.
+
+    The file is opened lazily, so that the dataset can be sent to worker
+    processes without copying its content, and all of them share the same
+    page cache. uint8 arrays are images, that are served as floats in
+    [0, 1]. All labels are 0. If an item_shape is given, the rows are
+    viewed with that shape."""
+
+    def __init__(self, filename, item_shape=None):
+        self.filename = filename
+        self.array = None
+        self.num_items = len(np.load(filename, mmap_mode='r'))
+        self.item_shape = item_shape
+
+    @property
+    def data(self):
+        if self.array is None:
+            # copy-on-write mapping: items are views, and never written back
+            self.array = np.load(self.filename, mmap_mode='c')
+        return self.array
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['array'] = None
+        return state
+
+    def __getitem__(self, index):
+        return self.get_batch(index), 0
+
+    def get_batch(self, indices):
+        """ returns the items at the given indices (an int, a slice or a
+        sequence) stacked in one tensor. Slices are views of the map."""
+        if not isinstance(indices, (int, slice)):
+            indices = np.asarray(indices)
+        items = torch.from_numpy(np.asarray(self.data[indices]))
+        if self.item_shape is not None:
+            single = (not isinstance(indices, slice)
+                      and np.ndim(indices) == 0)
+            items = items.reshape(
+                tuple(self.item_shape) if single
+                else (-1,) + tuple(self.item_shape))
+        if items.dtype == torch.uint8:
+            items = items.float().div_(255)
+        return items
+
+    def __len__(self):
+        return self.num_items
+
+
+class ArrayDataset(data.TensorDataset):
+    """TensorDataset of in-memory items and labels, whose items can also be
+    fetched by batches"""
+
+    def get_batch(self, indices):
+        """ returns the items at the given indices (an int, a slice or a
+        sequence) stacked in one tensor"""
+        if not isinstance(indices, (int, slice)):
+            indices = torch.as_tensor(indices, dtype=torch.long)
+        return self.tensors[0][indices]
+
+
+def get_batch(dataset, indices):
+    """returns the items of a dataset at the given indices, stacked in one
+    tensor. Datasets with a get_batch method serve them directly, others
+    item by item."""
+    if hasattr(dataset, 'get_batch'):
+        return dataset.get_batch(indices)
+    if isinstance(indices, slice):
+        indices = range(*indices.indices(len(dataset)))
+    return torch.stack([dataset[int(index)][0] for index in indices])
+
+
+def iterate_batches(dataset, batch_size, num_workers=0):
+    """yields the items of a dataset in order, by contiguous batches.
+    Datasets with a get_batch method serve each batch with a single slice,
+    others go through a DataLoader."""
+    if hasattr(dataset, 'get_batch'):
+        for start in range(0, len(dataset), batch_size):
+            yield dataset.get_batch(slice(start, start + batch_size))
+        return
+    loader = data.DataLoader(dataset, batch_size=batch_size, shuffle=False,
+                             num_workers=num_workers)
+    for (X, _) in loader:
+        yield X
+
+
+def save_batches(batches, num_items, filename, dtype=np.float32):
+    """writes batches of items to a (num_items, ...) .npy file. Everything
+    is first written to a temporary file, so that an interruption never
+    leaves an incomplete file."""
+    tmp_filename = filename + '.tmp'
+    array = None
+    position = 0
+    for batch in batches:
+        if array is None:
+            array = np.lib.format.open_memmap(
+                tmp_filename, mode='w+', dtype=dtype,
+                shape=(num_items,) + tuple(batch.shape[1:]))
+        array[position:position + len(batch)] = batch.numpy()
+        position += len(batch)
+    array.flush()
+    del array
+    os.replace(tmp_filename, filename)
+
+
+def store_images(dataset, filename, batch_size=64, num_workers=2):
+    """Converts an image dataset once to a uint8 .npy file, to be served by
+    a MemmapDataset. The images must be floats in [0, 1]. The file is
+    reused if it already exists."""
+    if not os.path.exists(filename):
+        print('storing images to', filename)
+        save_batches((X.mul(255).round_().to(torch.uint8)
+                      for X in iterate_batches(dataset, batch_size,
+                                               num_workers)),
+                     len(dataset), filename, dtype=np.uint8)
+    return MemmapDataset(filename)
+
+
+def encode_dataset(dataset, encode, filename=None, batch_size=256,
+                   device='cpu'):
+    """Encodes all the items of a dataset once, by batches.
+
+    If a filename is given, the codes are written to it as a
+    (num_items, code_size) float32 .npy file, that is reused if it already
+    exists, and a MemmapDataset over it is returned. Otherwise, the codes
+    are kept in memory in a TensorDataset."""
+    if filename is not None and os.path.exists(filename):
+        return MemmapDataset(filename)
+
+    def codes():
+        with torch.no_grad():
+            for X in iterate_batches(dataset, batch_size):
+                yield encode(X.to(device)).view(len(X), -1).cpu().float()
+
+    if filename is None:
+        codes = torch.cat(list(codes()))
+        return ArrayDataset(codes, torch.zeros(len(codes)))
+    save_batches(codes(), len(dataset), filename)
+    return MemmapDataset(filename)
+
+
+def load_in_memory(dataset, batch_size=1000, num_workers=2):
+    """Transforms once all the items of a torchvision dataset that holds
+    its data in memory, like MNIST or CIFAR10, and serves them from an
+    ArrayDataset, so that batches are slices instead of collated items.
+    Other datasets are returned as is."""
+    if not hasattr(dataset, 'data'):
+        return dataset
+    items = torch.cat(list(iterate_batches(dataset, batch_size,
+                                           num_workers)))
+    return ArrayDataset(items, torch.zeros(len(items)))
+
+
+def load_image_dataset(dataset, data_dir="data", img_size=None, mode='train',
+                       image_store=True):
+    """handles torchvision datasets and celebA. If image_store is True,
+    celebA is converted once to a memory-mapped uint8 array at the requested
+    size, from which the images are then read. The torchvision datasets
+    held in memory are transformed once, see load_in_memory."""
 
     # first define the transforms
     transform = transforms.Compose([
@@ -73,17 +235,22 @@ def load_image_dataset(dataset, data_dir="data", img_size=None, mode='train'):
     # If it's celebA, then we have a special loader
     if os.path.basename(dataset).upper() == "CELEBA":
         res_data = CelebA(data_dir, transform, mode=mode)
+        if image_store:
+            res_data = store_images(
+                res_data,
+                os.path.join(data_dir, 'CelebA',
+                             'images_%s_%d.npy' % (mode, img_size)))
     elif dataset.upper() == 'TOY':
-        import numpy as np
-        xdata = torch.tensor(np.load('toy.npy'))
-        ydata = torch.zeros(len(xdata))
-        res_data = data.TensorDataset(xdata[:, None, ...], ydata)
+        # the toy samples are memory-mapped, and served as (1, dim) items
+        res_data = MemmapDataset(
+            TOY_FILENAME,
+            item_shape=(1,) + np.load(TOY_FILENAME, mmap_mode='r').shape[1:])
     else:
         # Just assume it's a torchvision dataset
         DATASET = getattr(datasets, dataset)
-        res_data = DATASET(data_dir, train=(mode == 'train'),
-                           download=True,
-                           transform=transform)
+        res_data = load_in_memory(DATASET(data_dir, train=(mode == 'train'),
+                                          download=True,
+                                          transform=transform))
     return res_data
 
 
@@ -100,4 +267,10 @@ def add_data_arguments(parser):
                         help="Root directory of the dataset. Defaults to"
                              "`data`",
                         default='data')
+    parser.add_argument("--no_image_store",
+                        help="If active, celebA images are decoded from "
+                             "the jpeg files at each access, instead of "
+                             "being converted once to a memory-mapped "
+                             "array",
+                        action="store_true")
     return parser
@@ -9,8 +9,8 @@ NUM_EXAMPLES=5000
 IMG_SIZE=32
 
 # number of workers, increase or decrease depending on your equipment
-# note that if you are CUDA-equipped, AND using autoencoder, then the number
-# of dataworkers specified here will be ignored: only one will be used
+# note that when using the autoencoder, the dataset is encoded once before
+# the flow, and the workers then only read the codes
 NUM_DATAWORKERS=2
 NUM_SKETCHERS=2
 
@@ -28,6 +28,12 @@ NUM_EPOCHS=500
 # to change the sketch, set this to "--no_fixed_sketch"
 NO_FIXED_SKETCH_STRING=""
 
+# with NO_FIXED_SKETCH_STRING, set this to "--pipelined_sketches" to gather
+# the sketches of the next epoch while the current one is computed, with up
+# to STALE_FRACTION of them reused from the previous epoch when late
+PIPELINED_SKETCHES_STRING=""
+STALE_FRACTION=0
+
 # number of particles
 NUM_SAMPLES=5000
 
@@ -38,12 +44,38 @@ INPUT_DIM=10
 NUM_TEST=5000
 TEST_TYPE='RANDOM'
 
+# integration of the flow: momentum of the steps, "--adaptive_stepsize"
+# for Barzilai-Borwein stepsizes, and early stopping when the relative
+# improvement of the loss stays below TOLERANCE (0 for never)
+MOMENTUM=0
+ADAPTIVE_STEPSIZE_STRING=""
+TOLERANCE=0
+
+# computations of the flow: number of processes for the train particles
+# (cpu only), storage type (float32, float16 or bfloat16), and maximum
+# number of particles transported at once, e.g. "--chunk_size 10000"
+NUM_FLOW_WORKERS=1
+PRECISION=float32
+CHUNK_SIZE_STRING=""
+
+# checkpoints of the flow, e.g. "--checkpoint ~/swf_checkpoints/flow.pt"
+# and set RESUME_STRING to "--resume" to start again from it
+CHECKPOINT_STRING=""
+CHECKPOINT_EVERY=100
+RESUME_STRING=""
+
 # plot options
 PLOT_EVERY=10
 PLOT_NUM_TRAIN=104
 PLOT_NUM_TEST=96
 PLOT_NUM_FEATURES=2
 MATCH_EVERY=500
+# "--async_plot" to render the plots in a separate process
+ASYNC_PLOT_STRING=""
+# directory for the index of the closest entries of the data, e.g.
+# "--nn_index_dir ~/swf_cache", to share it between runs. Defaults to the
+# plot directory
+NN_INDEX_DIR_STRING=""
 
 if [ $1 = "toy" ]; then
   echo "generating toy data, and then SWF on it"
@@ -58,4 +90,4 @@ if [ $1 = "toy" ]; then
 fi
 
 # now launch the sliced Wasserstein flow
-python swf.py $1 $NO_FIXED_SKETCH_STRING  --root_data_dir ~/data --img_size $IMG_SIZE --num_sketches $NUM_SKETCHES --num_sketchers $NUM_SKETCHERS --num_dataworkers $NUM_DATAWORKERS --num_examples $NUM_EXAMPLES --num_quantiles $NUM_QUANTILES --input_dim $INPUT_DIM  --num_samples $NUM_SAMPLES --stepsize $STEPSIZE --regularization $REG --num_thetas $NUM_THETAS --num_epochs $NUM_EPOCHS $AE_STRING $CONV_AE_STRING --bottleneck_size $BOTTLENECK_SIZE --ae_model ae --num_test $NUM_TEST --test_type $TEST_TYPE --plot_dir ~/swf_samples_$1 --plot_every $PLOT_EVERY --match_every $MATCH_EVERY --plot_num_train $PLOT_NUM_TRAIN --plot_num_test $PLOT_NUM_TEST
+python swf.py $1 $NO_FIXED_SKETCH_STRING  --root_data_dir ~/data --img_size $IMG_SIZE --num_sketches $NUM_SKETCHES --num_sketchers $NUM_SKETCHERS --num_dataworkers $NUM_DATAWORKERS --num_examples $NUM_EXAMPLES --num_quantiles $NUM_QUANTILES --input_dim $INPUT_DIM  --num_samples $NUM_SAMPLES --stepsize $STEPSIZE --regularization $REG --num_thetas $NUM_THETAS --num_epochs $NUM_EPOCHS $AE_STRING $CONV_AE_STRING --bottleneck_size $BOTTLENECK_SIZE --ae_model ae --num_test $NUM_TEST --test_type $TEST_TYPE --plot_dir ~/swf_samples_$1 --plot_every $PLOT_EVERY --match_every $MATCH_EVERY --plot_num_train $PLOT_NUM_TRAIN --plot_num_test $PLOT_NUM_TEST $PIPELINED_SKETCHES_STRING --stale_fraction $STALE_FRACTION --momentum $MOMENTUM $ADAPTIVE_STEPSIZE_STRING --tolerance $TOLERANCE --num_flow_workers $NUM_FLOW_WORKERS --precision $PRECISION $CHUNK_SIZE_STRING $CHECKPOINT_STRING --checkpoint_every $CHECKPOINT_EVERY $RESUME_STRING $ASYNC_PLOT_STRING $NN_INDEX_DIR_STRING
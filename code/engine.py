@@ -0,0 +1,699 @@
+# fused computations for the inner loop of the sliced Wasserstein flow
+import torch
+from torchinterp1d import Interp1d
+from torchpercentile import Percentile
+import profiling
+
+
+class SliceStep:
+    """Fused slice step of a Sliced Wasserstein Flow.
+
+    Takes some particles and a whole stack of projection matrices, together
+    with the corresponding target quantiles, and computes in a single
+    batched pass the displacement accumulated over all the projections.
+    The buffers for projections, interpolations and the output displacement
+    are allocated once and reused as long as the shapes do not change.
+
+    Particles, thetas and projections may be stored with a lower precision
+    `dtype`, such as float16 or bfloat16: the projections are then products
+    of half precision matrices. The quantiles, the interpolations and the
+    displacements are always computed in float32, block after block of
+    projections, so that no float32 copy of the projections or of the
+    thetas is made.
+
+    If `chunk_size` is given, the particles are processed by chunks of that
+    size, so that the memory needed does not grow with their number. Their
+    quantiles are then obtained from a streaming summary in a first pass,
+    and the chunks are transported in a second one.
+
+    The sketches are processed by blocks of at most `max_projections`
+    projections, with the same buffers, and their displacements are summed.
+    The projections of a block are sorted by blocks of `block_size` of
+    them, so that the sorted values and ranks only take buffers of that
+    many columns.
+    """
+
+    def __init__(self, percentiles, dtype=torch.float32, chunk_size=None,
+                 num_merge_quantiles=None, block_size=1024,
+                 max_projections=4096, profiler=profiling.NULL_PROFILER):
+        """
+        percentiles: Tensor (num_quantiles,)
+            the percentiles at which the target quantiles are given, in
+            [0, 100]
+        dtype: torch.dtype
+            the storage type of the particles, thetas and projections
+        chunk_size: int or None
+            maximum number of particles processed at once. None means all.
+        num_merge_quantiles: int or None
+            number of quantiles in the streaming summary of the chunks.
+            Defaults to four times the number of percentiles.
+        block_size: int
+            number of projections sorted or converted at once
+        max_projections: int
+            number of projections of the blocks of whole sketches that are
+            projected and transported at once, so that the memory needed
+            does not grow with the number of sketches
+        profiler: profiling.Profiler
+            timers for the stages of the step. Nothing is timed by default.
+        """
+        self.dtype = dtype
+        self.profiler = profiler
+        self.percentiles = percentiles.float()
+        self.chunk_size = chunk_size
+        if num_merge_quantiles is None:
+            num_merge_quantiles = 4 * len(percentiles)
+        self.merge_percentiles = torch.linspace(
+            0, 100, num_merge_quantiles).to(self.percentiles)
+        self.block_size = block_size
+        self.max_projections = max_projections
+        self.buffers = {}
+        self.rank_weights = {}
+        self.targets = None
+
+    def buffer(self, name, shape, like, dtype=None):
+        """returns a buffer with the given name and shape, with the same
+        device as `like`, and its dtype unless another one is given. The
+        buffers of a name share their memory whatever their shape, so that
+        the blocks of different sizes reuse it: it is only reallocated if
+        it is too small."""
+        shape = torch.Size(shape)
+        dtype = like.dtype if dtype is None else dtype
+        buf = self.buffers.get(name)
+        if (buf is None or buf.dtype != dtype
+                or buf.device != like.device
+                or buf.numel() < shape.numel()):
+            buf = torch.empty(shape.numel(), dtype=dtype, device=like.device)
+            self.buffers[name] = buf
+        return buf[:shape.numel()].view(shape)
+
+    @staticmethod
+    def interpolation_weights(positions, grid):
+        """for each entry of `positions`, returns the index `idx` of the
+        interval of the increasing `grid` it falls in, as well as the
+        weight `w` so that it is given by (1-w)*grid[idx] + w*grid[idx+1].
+        Positions outside the grid are extrapolated."""
+        idx = torch.searchsorted(grid, positions, right=True) - 1
+        idx = idx.clamp(0, max(0, len(grid) - 2))
+        next_idx = (idx + 1).clamp(max=len(grid) - 1)
+        delta = grid[next_idx] - grid[idx]
+        weights = (positions - grid[idx]) / delta.masked_fill(delta == 0, 1)
+        return (idx, next_idx, weights)
+
+    def quantiles_weights(self, num_particles, percentiles, device):
+        """ interpolation weights for the quantiles of `num_particles`
+        sorted values at the given percentiles, in float32"""
+        ranks = torch.arange(num_particles, dtype=self.percentiles.dtype,
+                             device=device)
+        return self.interpolation_weights(
+            percentiles.to(ranks) / 100 * (num_particles - 1), ranks)
+
+    def rank_weights_for(self, num_particles, like):
+        """gets the interpolation weights for the quantiles of `num_particles`
+        sorted values, and for the target quantiles at the CDF levels of
+        each rank, on the device of `like`. Those only depend on the number
+        of particles and the percentiles, so they are computed once."""
+        key = (num_particles, like.device)
+        if key not in self.rank_weights:
+            percentiles = self.percentiles.to(like.device)
+            # positions of the percentiles among the sorted particles
+            quantiles_weights = self.quantiles_weights(
+                num_particles, percentiles, like.device)
+
+            # CDF levels of the ranks, among the percentiles
+            levels = (torch.arange(num_particles, dtype=percentiles.dtype,
+                                   device=like.device)
+                      * 100 / max(1, num_particles - 1))
+            targets_weights = self.interpolation_weights(levels, percentiles)
+            self.rank_weights[key] = (quantiles_weights, targets_weights)
+        return self.rank_weights[key]
+
+    def sorted_blocks(self, projections):
+        """sorts the (num_particles, num_projections) projections by blocks
+        of `block_size` columns. Yields (columns, sorted_block, order) for
+        each block, where the sorted values and their indices are buffers
+        reused from one block to the next."""
+        num_projections = projections.shape[1]
+        for start in range(0, num_projections, self.block_size):
+            block = projections[:, start:start + self.block_size]
+            sorted_block = self.buffer('sorted', block.shape, projections)
+            order = self.buffer('order', block.shape, projections,
+                                dtype=torch.long)
+            torch.sort(block, dim=0, out=(sorted_block, order))
+            yield (slice(start, start + block.shape[1]), sorted_block, order)
+
+    @staticmethod
+    def sorted_quantiles(sorted_block, weights):
+        """ float32 quantiles of sorted values, interpolated with the given
+        (idx, next_idx, w) weights"""
+        (idx, next_idx, w) = weights
+        return torch.lerp(sorted_block[idx].to(w),
+                          sorted_block[next_idx].to(w), w[:, None])
+
+    def quantiles(self, projections, percentiles=None):
+        """quantiles of the (num_particles, num_projections) projections, in
+        float32. They are given at `percentiles`, or at the percentiles of
+        the target quantiles if None.
+
+        returns a (num_quantiles, num_projections) Tensor"""
+        num_particles = projections.shape[0]
+        if percentiles is None:
+            (weights, _) = self.rank_weights_for(num_particles, projections)
+        else:
+            weights = self.quantiles_weights(num_particles, percentiles,
+                                             projections.device)
+        particles_qf = projections.new_empty(
+            len(weights[0]), projections.shape[1], dtype=weights[2].dtype)
+        for (columns, sorted_block, _) in self.sorted_blocks(projections):
+            particles_qf[:, columns] = self.sorted_quantiles(sorted_block,
+                                                             weights)
+        return particles_qf
+
+    def rank_targets(self, target_qf, num_particles, rows=None):
+        """the target quantiles at the CDF level of each rank of
+        `num_particles` sorted values, as a (num_projections, num_particles)
+        tensor of type `dtype`. If `rows` is given, only the projections
+        of that slice of the flattened target quantiles are considered.
+
+        They only depend on the target quantiles: they are kept as long as
+        the same `target_qf` tensor and rows are given, so that fixed
+        sketches are interpolated only once if they fit in a single block.
+        Only the targets of the last block are kept. `target_qf` must thus
+        not be modified in place."""
+        flat_qf = target_qf.reshape(-1, target_qf.shape[-1])
+        rows = slice(0, flat_qf.shape[0]) if rows is None else rows
+        key = (rows.start, rows.stop, num_particles)
+        if (self.targets is not None and self.targets[0] is target_qf
+                and self.targets[1] == key):
+            return self.targets[2]
+        flat_qf = flat_qf[rows].to(self.percentiles)
+        (_, (t_idx, t_next, t_w)) = self.rank_weights_for(num_particles,
+                                                          flat_qf)
+        # the previous targets are overwritten, if they have the same shape
+        shape = (flat_qf.shape[0], num_particles)
+        targets = (self.targets[2] if self.targets is not None
+                   and self.targets[2].shape == shape
+                   else flat_qf.new_empty(shape, dtype=self.dtype))
+        self.targets = None
+        for start in range(0, shape[0], self.block_size):
+            block = flat_qf[start:start + self.block_size]
+            lower = self.buffer('lower', (len(block), num_particles),
+                                flat_qf)
+            upper = self.buffer('upper', (len(block), num_particles),
+                                flat_qf)
+            torch.index_select(block, 1, t_idx, out=lower)
+            torch.index_select(block, 1, t_next, out=upper)
+            targets[start:start + len(block)] = lower.lerp_(upper,
+                                                            t_w[None, :])
+        self.targets = (target_qf, key, targets)
+        return targets
+
+    def rank_transport(self, projections, target_qf, rows=None):
+        """Transports the projections to the target quantiles through their
+        exact empirical CDF, given by their ranks.
+
+        projections: Tensor (num_particles, num_projections)
+        target_qf: Tensor (num_projections, num_quantiles)
+            or (num_sketches, num_thetas, num_quantiles). Their
+            interpolation at the ranks is kept, see rank_targets.
+        rows: slice or None
+            if given, the projections are those of this slice of the
+            flattened target quantiles
+
+        returns (particles_qf, transported) with shapes
+        (num_quantiles, num_projections) and (num_projections, num_particles)
+        """
+        (num_particles, num_projections) = projections.shape
+        (weights, _) = self.rank_weights_for(num_particles, projections)
+        targets = self.rank_targets(target_qf, num_particles, rows)
+        particles_qf = projections.new_empty(
+            len(weights[0]), num_projections, dtype=weights[2].dtype)
+        transported = self.buffer(
+            'transported', (num_projections, num_particles), projections)
+
+        # a single sort per projection gives both the quantiles of the
+        # particles and their ranks. The target quantiles at the CDF level
+        # of each rank are put back in the original order of the particles
+        for (columns, sorted_block, order) in self.sorted_blocks(projections):
+            particles_qf[:, columns] = self.sorted_quantiles(sorted_block,
+                                                             weights)
+            transported[columns].scatter_(1, order.t(), targets[columns])
+        return (particles_qf, transported)
+
+    def project(self, particles, thetas):
+        """projects the particles on all the thetas at once.
+
+        particles: Tensor (num_particles, ...)
+        thetas: Tensor (num_projections, dim)
+
+        returns a (num_particles, num_projections) Tensor of type `dtype`"""
+        num_particles = particles.shape[0]
+        particles = particles.view(num_particles, -1).to(self.dtype)
+        thetas = thetas.to(self.dtype)
+        projections = self.buffer(
+            'projections', (num_particles, thetas.shape[0]), particles)
+        return project(particles, thetas, out=projections)
+
+    def reference_transport(self, projections, target_qf, reference_qf):
+        """Transports the projections to the target quantiles through the
+        CDF of a reference, obtained by interpolating its quantiles.
+
+        Both quantiles are given at the same percentiles: a projection
+        falling between two quantiles of the reference has a CDF level
+        between the corresponding percentiles, and is thus sent between the
+        corresponding target quantiles, with the same weight. This is done
+        in float32, by blocks of projections.
+
+        projections: Tensor (num_particles, num_projections)
+        target_qf: Tensor (num_projections, num_quantiles)
+        reference_qf: Tensor (num_quantiles, num_projections)
+
+        returns a (num_projections, num_particles) Tensor"""
+        (num_particles, num_projections) = projections.shape
+        transported = self.buffer(
+            'transported', (num_projections, num_particles), projections)
+        reference = reference_qf.t().to(self.percentiles).contiguous()
+        target_qf = target_qf.to(self.percentiles)
+        # the linear pieces of the transport, between successive quantiles
+        delta = reference[:, 1:] - reference[:, :-1]
+        slopes = ((target_qf[:, 1:] - target_qf[:, :-1])
+                  / delta.masked_fill(delta == 0, 1))
+        for start in range(0, num_projections, self.block_size):
+            rows = slice(start, start + self.block_size)
+            block = projections[:, rows].t()
+            values = self.buffer('values', block.shape, reference)
+            aux = self.buffer('aux', block.shape, reference)
+            idx = self.buffer('idx', block.shape, reference,
+                              dtype=torch.long)
+            values.copy_(block)
+            torch.searchsorted(reference[rows], values, right=True, out=idx)
+            idx.sub_(1).clamp_(0, max(0, reference.shape[1] - 2))
+            values.sub_(torch.gather(reference[rows], 1, idx, out=aux))
+            values.mul_(torch.gather(slopes[rows], 1, idx, out=aux))
+            values.add_(torch.gather(target_qf[rows], 1, idx, out=aux))
+            transported[rows] = values
+        return transported
+
+    def backproject(self, transported, projections, thetas, out=None,
+                    accumulate=False):
+        """goes back to the particles space, accumulating the displacements
+        over all thetas in float32. `transported` is modified in place. The
+        result is written to `out` if given, or added to it if `accumulate`
+        is True.
+
+        With a lower precision, the displacements and the thetas are
+        converted to float32 by blocks of projections.
+
+        returns a (num_particles, dim) Tensor"""
+        if out is None:
+            out = self.buffer(
+                'displacement', (projections.shape[0], thetas.shape[1]),
+                self.percentiles)
+        if not torch.is_tensor(thetas):
+            transported.sub_(projections.t())
+            thetas = thetas.to(out.dtype)
+            if not accumulate:
+                return thetas.backproject(transported.t(), out=out)
+            return out.add_(thetas.backproject(
+                transported.t(),
+                out=self.buffer('block_displacement', out.shape, out)))
+        if transported.dtype == out.dtype:
+            transported.sub_(projections.t())
+            if not accumulate:
+                return torch.mm(transported.t(), thetas.to(out.dtype),
+                                out=out)
+            return out.addmm_(transported.t(), thetas.to(out.dtype))
+        if not accumulate:
+            out.zero_()
+        for start in range(0, thetas.shape[0], self.block_size):
+            rows = slice(start, start + self.block_size)
+            moves = self.buffer('moves', transported[rows].shape, out)
+            weights = self.buffer('weights', thetas[rows].shape, out)
+            moves.copy_(transported[rows])
+            moves.sub_(projections[:, rows].t())
+            weights.copy_(thetas[rows])
+            out.addmm_(moves.t(), weights)
+        return out
+
+    def sketch_blocks(self, thetas):
+        """splits the (num_sketches, num_thetas, dim) thetas in blocks of
+        whole sketches, with at most `max_projections` projections unless a
+        single sketch has more. Yields (rows, block_thetas, accumulate) for
+        each block, with rows the slice of its projections among all of
+        them, block_thetas its (num_projections, dim) thetas, and accumulate
+        whether it comes after the first block."""
+        (num_sketches, num_thetas, dim) = thetas.shape
+        per_block = max(1, self.max_projections // num_thetas)
+        for start in range(0, num_sketches, per_block):
+            stop = min(start + per_block, num_sketches)
+            yield (slice(start * num_thetas, stop * num_thetas),
+                   thetas[start:stop].view((stop - start) * num_thetas, dim),
+                   start > 0)
+
+    def block_step(self, particles, thetas, target_qf, rows, reference_qf,
+                   with_loss, out, accumulate):
+        """displacement of the particles for the projections on a block of
+        thetas, written to `out` or added to it if `accumulate`. The
+        target quantiles of the block are the `rows` of the flattened
+        `target_qf`, and reference_qf are the reference quantiles of the
+        block, if any.
+
+        returns the quantiles of the projected particles, or None if they
+        are not needed"""
+        profiler = self.profiler
+        with profiler.section('projection'):
+            projections = self.project(particles, thetas)
+        if reference_qf is None:
+            # the particles are transported with their own distribution:
+            # their CDF level is given exactly by their rank
+            with profiler.section('quantile'):
+                (particles_qf, transported) = self.rank_transport(
+                    projections, target_qf, rows)
+        else:
+            # transport the marginals by interpolating the CDF of the
+            # reference. The quantiles are only needed for the loss.
+            particles_qf = None
+            if with_loss:
+                with profiler.section('quantile'):
+                    particles_qf = self.quantiles(projections)
+            with profiler.section('interp'):
+                transported = self.reference_transport(
+                    projections,
+                    target_qf.reshape(-1, target_qf.shape[-1])[rows],
+                    reference_qf)
+        with profiler.section('backward'):
+            self.backproject(transported, projections, thetas, out=out,
+                             accumulate=accumulate)
+        return particles_qf
+
+    def __call__(self, particles, thetas, target_qf, reference_qf=None,
+                 with_loss=True):
+        """Computes the displacement of the particles.
+
+        The sketches are processed by blocks of at most `max_projections`
+        projections, whose displacements are summed in the same buffer.
+
+        particles: Tensor (num_particles, ...)
+            the particles to transport
+        thetas: Tensor (num_sketches, num_thetas, dim)
+            the stack of projection matrices, with dim the flattened
+            dimension of the particles. It may also be a
+            projection.SRHTStack, that is applied with fast transforms.
+        target_qf: Tensor (num_sketches, num_thetas, num_quantiles)
+            the target quantiles for each projection
+        reference_qf: Tensor (num_quantiles, num_sketches*num_thetas) or None
+            the quantiles of the particles whose empirical CDF is used for
+            transport. If None, the quantiles of `particles` are used.
+        with_loss: boolean
+            when a reference is given, the quantiles of the particles are
+            only needed for the loss. If with_loss is False, they are not
+            computed, and None is returned instead of them and of the loss.
+
+        returns (displacement, particles_qf, loss) where displacement has
+        the shape of the particles and is the sum over all projections,
+        in float32,
+        particles_qf are the quantiles of the projected particles with
+        shape (num_quantiles, num_sketches*num_thetas), and loss is the
+        squared error between particles_qf and target_qf, averaged for
+        each sketch and summed over sketches.
+        """
+        (num_sketches, num_thetas, dim) = thetas.shape
+        flat_qf = target_qf.view(num_sketches * num_thetas, -1).to(
+            self.percentiles)
+        flat_particles = particles.view(particles.shape[0], -1)
+        chunked = (self.chunk_size is not None
+                   and particles.shape[0] > self.chunk_size)
+        particles_qf = None
+        if reference_qf is None or with_loss:
+            particles_qf = flat_qf.new_empty(len(self.percentiles),
+                                             flat_qf.shape[0])
+        displacement = self.buffer('displacement', flat_particles.shape,
+                                   self.percentiles)
+        for (rows, block_thetas, accumulate) in self.sketch_blocks(thetas):
+            block_reference = (None if reference_qf is None
+                               else reference_qf[:, rows])
+            if chunked:
+                block_qf = self.chunked(
+                    flat_particles, block_thetas, flat_qf[rows],
+                    block_reference, with_loss, displacement, accumulate)
+            else:
+                block_qf = self.block_step(
+                    flat_particles, block_thetas, target_qf, rows,
+                    block_reference, with_loss, displacement, accumulate)
+            if particles_qf is not None:
+                particles_qf[:, rows] = block_qf
+        loss = (None if particles_qf is None
+                else sliced_loss(particles_qf, flat_qf, num_sketches))
+        return (displacement.view(particles.shape), particles_qf, loss)
+
+    def joint(self, particles, num_train, thetas, target_qf,
+              with_test_loss=True):
+        """Computes the displacements of train and test particles in one
+        pass. The train particles are transported with their own
+        distribution, while the test ones are only pushed forward with the
+        quantiles of the train ones. Both are projected with a single
+        product, block of sketches after block of sketches.
+
+        particles: Tensor (num_train + num_test, ...)
+            the train particles, followed by the test ones
+        num_train: int
+            number of train particles
+        thetas: Tensor (num_sketches, num_thetas, dim)
+        target_qf: Tensor (num_sketches, num_thetas, num_quantiles)
+        with_test_loss: boolean
+            whether to compute the loss of the test particles
+
+        returns (displacement, train_qf, train_loss, test_loss), with
+        displacement of the shape of the particles, train_qf the quantiles
+        of the projected train particles and test_loss None if not asked
+        for."""
+        (num_sketches, num_thetas, dim) = thetas.shape
+        flat_qf = target_qf.view(num_sketches * num_thetas, -1).to(
+            self.percentiles)
+        profiler = self.profiler
+        displacement = self.buffer(
+            'joint_displacement', (particles.shape[0], dim), self.percentiles)
+        train_qf = flat_qf.new_empty(len(self.percentiles), flat_qf.shape[0])
+        test_qf = (flat_qf.new_empty(train_qf.shape) if with_test_loss
+                   else None)
+        for (rows, block_thetas, accumulate) in self.sketch_blocks(thetas):
+            with profiler.section('projection'):
+                projections = self.project(particles, block_thetas)
+
+            # train particles first: their transported values are brought
+            # back before the buffer is reused for the test ones
+            train = projections[:num_train]
+            with profiler.section('quantile'):
+                (train_qf[:, rows], transported) = self.rank_transport(
+                    train, target_qf, rows)
+            with profiler.section('backward'):
+                self.backproject(transported, train, block_thetas,
+                                 out=displacement[:num_train],
+                                 accumulate=accumulate)
+
+            test = projections[num_train:]
+            if with_test_loss:
+                with profiler.section('quantile'):
+                    test_qf[:, rows] = self.quantiles(test)
+            with profiler.section('interp'):
+                transported = self.reference_transport(
+                    test, flat_qf[rows], train_qf[:, rows])
+            with profiler.section('backward'):
+                self.backproject(transported, test, block_thetas,
+                                 out=displacement[num_train:],
+                                 accumulate=accumulate)
+        train_loss = sliced_loss(train_qf, flat_qf, num_sketches)
+        test_loss = (None if test_qf is None
+                     else sliced_loss(test_qf, flat_qf, num_sketches))
+        return (displacement.view(particles.shape), train_qf, train_loss,
+                test_loss)
+
+    def summary(self, particles, thetas):
+        """quantiles of the projected particles at `merge_percentiles`,
+        computed chunk after chunk and merged in a streaming fashion.
+
+        returns a (num_merge_quantiles, num_projections) Tensor"""
+        particles = particles.view(particles.shape[0], -1)
+        chunk_size = self.chunk_size or particles.shape[0]
+        summary = StreamingQuantiles(None, self.merge_percentiles)
+        for chunk in particles.split(chunk_size):
+            projections = self.project(chunk, thetas)
+            summary.add(self.quantiles(projections, self.merge_percentiles),
+                        chunk.shape[0])
+        return summary.summary
+
+    def transport(self, particles, thetas, target_qf, reference_qf,
+                  out=None, accumulate=False):
+        """displacement of the particles transported with the CDF of the
+        reference, chunk after chunk. It is written to `out` if given, or
+        added to it if `accumulate` is True.
+
+        returns a (num_particles, dim) Tensor"""
+        particles = particles.view(particles.shape[0], -1)
+        chunk_size = self.chunk_size or particles.shape[0]
+        if out is None:
+            out = self.buffer('chunked_displacement', particles.shape,
+                              self.percentiles)
+        start = 0
+        for chunk in particles.split(chunk_size):
+            projections = self.project(chunk, thetas)
+            transported = self.reference_transport(
+                projections, target_qf, reference_qf)
+            self.backproject(transported, projections, thetas,
+                             out=out[start:start + chunk.shape[0]],
+                             accumulate=accumulate)
+            start += chunk.shape[0]
+        return out
+
+    def chunked(self, particles, thetas, target_qf, reference_qf, with_loss,
+                out, accumulate):
+        """Same as a block step, but with the particles processed by
+        chunks. thetas and target_qf are given as (num_projections, dim)
+        and (num_projections, num_quantiles)."""
+        # first pass: the quantiles of the particles from a streaming
+        # summary, unless they are not needed
+        particles_qf = None
+        if reference_qf is None or with_loss:
+            with self.profiler.section('quantile'):
+                summary = self.summary(particles, thetas)
+            particles_qf = Interp1d()(
+                x=self.merge_percentiles,
+                y=summary.t().contiguous(),
+                xnew=self.percentiles.expand(summary.shape[1], -1)).t()
+        if reference_qf is None:
+            reference_qf = particles_qf
+
+        # second pass: transport each chunk
+        with self.profiler.section('transport'):
+            self.transport(particles, thetas, target_qf, reference_qf,
+                           out=out, accumulate=accumulate)
+        return particles_qf
+
+
+def project(particles, thetas, out=None):
+    """projects (num_particles, dim) particles on a (num_projections, dim)
+    matrix of thetas, or on structured thetas that are not stored as
+    matrices, like a projection.SRHTStack."""
+    if torch.is_tensor(thetas):
+        return torch.mm(particles, thetas.t(), out=out)
+    return thetas.project(particles, out=out)
+
+
+class StreamingQuantiles:
+    """Mergeable summaries of the distributions of many projections of
+    streamed data.
+
+    Each batch of data is projected on all the thetas with a single
+    product, and summarized by its quantiles at the summary levels. As in
+    a binary counter, summaries standing for similar numbers of items are
+    merged with merge_quantiles, so that each item goes through a number of
+    merges that is only logarithmic in the number of batches. The memory
+    needed doesn't depend on the number of items, and summaries built
+    separately can be merged."""
+
+    def __init__(self, thetas, levels, dtype=torch.float32):
+        """
+        thetas: Tensor (num_projections, dim) or None
+            the thetas the data are projected on by `update`. If None,
+            summaries are only given with `add`.
+        levels: Tensor (num_levels,)
+            the percentiles of the summary, in [0, 100]. The quantiles are
+            exact at these levels as long as a single batch was seen.
+        dtype: torch.dtype
+            the type for projections and summaries
+        """
+        self.thetas = None if thetas is None else thetas.to(dtype)
+        self.levels = levels.to(
+            dtype=dtype,
+            device=levels.device if thetas is None else thetas.device)
+        self.stack = []
+
+    def update(self, batch):
+        """ adds a (batch_size, ...) batch of data to the summary"""
+        projections = project(batch.view(batch.shape[0], -1).to(self.levels),
+                              self.thetas)
+        self.add(Percentile()(projections, self.levels), batch.shape[0])
+
+    def add(self, summary, count):
+        """ adds the (num_levels, num_projections) summary of count items"""
+        self.stack += [(summary, count)]
+        while (len(self.stack) > 1
+               and self.stack[-2][1] <= 2 * self.stack[-1][1]):
+            (last, previous) = (self.stack.pop(), self.stack.pop())
+            self.stack += [(
+                merge_quantiles(torch.stack((previous[0], last[0])),
+                                [previous[1], last[1]], self.levels,
+                                self.levels),
+                previous[1] + last[1])]
+
+    @property
+    def count(self):
+        return sum(count for (_, count) in self.stack)
+
+    @property
+    def summary(self):
+        """ the (num_levels, num_projections) summary of all the items"""
+        if len(self.stack) > 1:
+            self.stack = [(
+                merge_quantiles(torch.stack([s for (s, _) in self.stack]),
+                                [count for (_, count) in self.stack],
+                                self.levels, self.levels),
+                self.count)]
+        return self.stack[0][0] if self.stack else None
+
+    def quantiles(self, percentiles):
+        """ returns the (num_quantiles, num_projections) quantiles of the
+        data seen so far, at the given percentiles"""
+        percentiles = percentiles.to(self.levels)
+        summary = self.summary
+        return Interp1d()(
+            x=self.levels,
+            y=summary.t().contiguous(),
+            xnew=percentiles.expand(summary.shape[1], -1)).t()
+
+
+def merge_quantiles(local_qf, counts, percentiles, levels=None):
+    """Merges the quantiles of several sets of particles into the quantiles
+    of their union.
+
+    Each set is described by the piecewise linear CDF going through its
+    quantiles. The CDF of the union is the mixture of these CDFs, weighted
+    by the number of particles of each set: it is evaluated at all the
+    local quantiles, and inverted at the requested percentiles. Merging a
+    single set gives back its quantiles.
+
+    local_qf: Tensor (num_sets, num_levels, num_projections)
+    counts: list of int
+        number of particles in each set
+    percentiles: Tensor (num_quantiles,)
+    levels: Tensor (num_levels,) or None
+        the percentiles of the local quantiles. Defaults to evenly spaced
+        levels from 0 to 100.
+
+    returns a (num_quantiles, num_projections) Tensor
+    """
+    (num_sets, num_levels, num_projections) = local_qf.shape
+    if levels is None:
+        levels = torch.linspace(0, 100, num_levels)
+    levels = levels.to(local_qf)
+    weights = torch.tensor(counts, dtype=local_qf.dtype)
+    weights = weights / weights.sum()
+
+    local = local_qf.permute(0, 2, 1).contiguous()
+    (points, _) = torch.sort(local.permute(1, 0, 2).reshape(
+        num_projections, -1), dim=1)
+    cdf = torch.zeros_like(points)
+    for (set_qf, weight) in zip(local, weights.tolist()):
+        set_cdf = Interp1d()(x=set_qf, y=levels, xnew=points)
+        cdf += weight * set_cdf.clamp_(0, 100)
+    percentiles = percentiles.to(local_qf)
+    return Interp1d()(x=cdf, y=points,
+                      xnew=percentiles.expand(num_projections, -1)).t()
+
+
+def sliced_loss(particles_qf, target_qf, num_sketches):
+    """squared error between the quantiles of the particles, given as
+    (num_quantiles, num_projections), and the target quantiles, given as
+    (num_projections, num_quantiles). This is averaged for each sketch and
+    summed over the sketches."""
+    return ((particles_qf.t() - target_qf)**2).sum() * num_sketches / (
+        target_qf.numel())
@@ -20,42 +20,87 @@ def draw_GMM_parameters(d, K, seed=None):
     # covariances
     L = (randn(d, d, K) * rand(1, 1, K) * K
          + np.eye(d)[..., None]*randn(1, 1, K)*np.sqrt(K))
-    C = np.sum(L[..., None, :] * np.rollaxis(L, 1)[None, ...], axis=1)
+    C = np.einsum('ijk,ljk->ilk', L, L)
 
-    # compute inverses of covariances
-    invC = np.zeros(C.shape)
-    for k in range(K):
-        invC[..., k] = np.linalg.pinv(C[..., k])
+    return {'mu': mu, 'K': K, 'w': w, 'L': L, 'C': C}
 
-    return {'mu': mu, 'K': K, 'w': w, 'L': L, 'C': C, 'invC': invC}
 
+def chunk_rows(row_size, chunk_bytes):
+    ''' number of rows of row_size float64 values that fit in chunk_bytes,
+    at least one '''
+    return max(1, chunk_bytes // (8 * row_size))
 
-def rand_GMM(params, T):
-    ''' draw outcomes from a GMM '''
-    # allocate output
-    d = params['mu'].shape[0]
-    x = np.zeros((T, d))
-    y = np.zeros((T,))
-
-    pos = 0
-    for k in range(params['K']):
-        # for each component, first pick the number of samples according to
-        # the component weight
-        Tc = min(T-pos, int(T*params['w'][k]))
 
-        # draw the samples from this component
-        xc = randn(d, Tc)
-        xc = np.dot(params['L'][..., k], xc) + params['mu'][:, k][..., None]
-
-        # aggregate to the output
-        x[pos:pos+Tc] = xc.T
-        y[pos:pos + Tc] = k
-        pos += Tc
+def rand_GMM(params, T, filename=None, chunk_bytes=2**28):
+    ''' draw outcomes from a GMM. The samples are drawn by chunks of about
+    chunk_bytes of float64 values, and those of all the components are
+    drawn together. If a filename is given, they are streamed
+    to a .npy file, and their labels to a _labels.npy file along it, that
+    are returned memory-mapped, so that T may exceed the available memory.
+    '''
+    d = params['mu'].shape[0]
+    K = params['K']
+    # (K, d, d) and (K, d) versions of the parameters, for the products
+    L = np.ascontiguousarray(np.moveaxis(params['L'], -1, 0))
+    mu = np.ascontiguousarray(params['mu'].T)
+    w = params['w'] / np.sum(params['w'])
 
-    order = np.random.permutation(T)
-    x = x.flatten()[order] if d == 1 else x[order]
-    y = y[order]
-    return (x.astype(np.float32), y)
+    # allocate output
+    shape = (T,) if d == 1 else (T, d)
+    labels_dtype = np.min_scalar_type(max(K - 1, 0))
+    if filename is None:
+        x = np.zeros(shape, dtype=np.float32)
+        y = np.zeros((T,), dtype=labels_dtype)
+    else:
+        x = np.lib.format.open_memmap(filename, mode='w+', dtype=np.float32,
+                                      shape=shape)
+        y = np.lib.format.open_memmap(
+            filename[:-len('.npy')] + '_labels.npy', mode='w+',
+            dtype=labels_dtype, shape=(T,))
+
+    chunk_size = chunk_rows(d, chunk_bytes)
+    for pos in range(0, T, chunk_size):
+        Tc = min(chunk_size, T - pos)
+        # number of samples of each component in this chunk
+        counts = np.random.multinomial(Tc, w)
+        labels = np.repeat(np.arange(K), counts)
+
+        # the white samples are grouped by component, padded to the size of
+        # the largest group, and all the groups are colored with one
+        # batched product with the stacked Cholesky factors
+        groups = np.zeros((K, counts.max(), d))
+        drawn = np.arange(counts.max())[None, :] < counts[:, None]
+        groups[drawn] = randn(Tc, d)
+        xc = np.matmul(groups, L.transpose(0, 2, 1))[drawn] + mu[labels]
+
+        # shuffle within the chunk, and aggregate to the output
+        order = np.random.permutation(Tc)
+        x[pos:pos + Tc] = xc[order].reshape((Tc,) + shape[1:])
+        y[pos:pos + Tc] = labels[order]
+
+    if filename is not None:
+        x.flush()
+        y.flush()
+    return (x, y)
+
+
+def normalize(X, chunk_bytes=2**28):
+    ''' centers the samples and scales them to unit average norm, in
+    place and by chunks of about chunk_bytes '''
+    num = len(X)
+    chunk_size = chunk_rows(max(1, X[:1].size), chunk_bytes)
+    mean = sum(np.sum(X[pos:pos + chunk_size], dtype=np.float64)
+               for pos in range(0, num, chunk_size)) / X.size
+    norm = 0
+    for pos in range(0, num, chunk_size):
+        X[pos:pos + chunk_size] -= mean
+        chunk = X[pos:pos + chunk_size].reshape(
+            min(chunk_size, num - pos), -1)
+        norm += np.sum(np.linalg.norm(chunk, axis=1), dtype=np.float64)
+    norm /= num
+    for pos in range(0, num, chunk_size):
+        X[pos:pos + chunk_size] /= norm
+    return X
 
 
 if __name__ == "__main__":
@@ -88,15 +133,17 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
     params = draw_GMM_parameters(args.dim, args.num_components, args.seed)
-    (X, Y) = rand_GMM(params, args.num_samples)
-
-    X = X - np.mean(X.flatten())
-    X /= np.mean((np.linalg.norm(X, axis=1)))
+    filename = None
+    if args.output is not None:
+        filename = (args.output if args.output.endswith('.npy')
+                    else args.output + '.npy')
+    (X, Y) = rand_GMM(params, args.num_samples, filename=filename)
+    normalize(X)
 
     if args.plot:
         pl.plot(X[:, 0], X[:, 1], '.')
         pl.grid(True)
         pl.show()
 
-    if args.output is not None:
-        np.save(args.output, X)
+    if filename is not None:
+        X.flush()
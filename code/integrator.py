@@ -0,0 +1,174 @@
+# integration of the particles along the sliced Wasserstein flow
+import torch
+
+
+def add_integrator_arguments(parser):
+    parser.add_argument("--momentum",
+                        help="momentum of the particles updates. 0 means "
+                             "plain steps",
+                        type=float,
+                        default=0)
+    parser.add_argument("--nesterov",
+                        help="If active, the momentum is Nesterov's",
+                        action="store_true")
+    parser.add_argument("--adaptive_stepsize",
+                        help="If active, the stepsize is adapted at each "
+                             "epoch with a Barzilai-Borwein rule computed "
+                             "on the train particles",
+                        action="store_true")
+    parser.add_argument("--stepsize_range",
+                        help="With --adaptive_stepsize, the stepsize is "
+                             "kept within this factor of --stepsize",
+                        type=float,
+                        default=100)
+    parser.add_argument("--tolerance",
+                        help="If positive, the flow stops when the relative "
+                             "improvement of the train loss stays below "
+                             "this for --patience epochs",
+                        type=float,
+                        default=0)
+    parser.add_argument("--patience",
+                        help="number of epochs without improvement before "
+                             "stopping, with --tolerance",
+                        type=int,
+                        default=20)
+    return parser
+
+
+class Integrator:
+    """Applies the steps of the flow to the particles.
+
+    By default, the particles move by stepsize times the average
+    displacement over the projections. With momentum, the moves are
+    accumulated in a velocity, possibly with Nesterov's look-ahead.
+
+    With an adaptive stepsize, the Barzilai-Borwein rule is applied on the
+    train particles: the displacement is the opposite of the gradient of the
+    sliced Wasserstein loss, so that the stepsize is estimated as
+    <s, s> / <s, y>, with s the last move and y the change of gradient. It
+    is kept within `stepsize_range` of the initial stepsize, and left
+    unchanged when the estimate is not positive."""
+
+    def __init__(self, stepsize, momentum=0, nesterov=False, adaptive=False,
+                 stepsize_range=100):
+        """
+        stepsize: float
+            the (initial) stepsize
+        momentum: float
+            momentum factor, in [0, 1)
+        nesterov: boolean
+            whether to use Nesterov's momentum
+        adaptive: boolean
+            whether to adapt the stepsize with the Barzilai-Borwein rule
+        stepsize_range: float
+            the adapted stepsize stays in [stepsize/range, stepsize*range]
+        """
+        self.base_stepsize = stepsize
+        self.stepsize = stepsize
+        self.momentum = momentum
+        self.nesterov = nesterov
+        self.adaptive = adaptive
+        self.stepsize_range = stepsize_range
+        self.velocity = {}
+        self.last_move = None
+        self.last_direction = None
+
+    @property
+    def plain(self):
+        """ whether the updates are plain constant steps"""
+        return not self.momentum and not self.adaptive
+
+    def adapt(self, direction):
+        """updates the stepsize from the displacement of the train
+        particles, averaged over the projections"""
+        if not self.adaptive:
+            return
+        direction = direction.float()
+        if self.last_move is not None:
+            # the gradient is the opposite of the displacement
+            change = self.last_direction - direction
+            curvature = (self.last_move * change).sum().item()
+            if curvature > 0:
+                stepsize = (self.last_move**2).sum().item() / curvature
+                self.stepsize = min(
+                    max(stepsize, self.base_stepsize / self.stepsize_range),
+                    self.base_stepsize * self.stepsize_range)
+        self.last_direction = direction.clone()
+
+    def __call__(self, task, particles, step, weight):
+        """moves the particles in place with a step, given as the sum of the
+        displacements over `weight` projections"""
+        if self.plain:
+            particles += self.stepsize / weight * step
+            return
+        move = (self.stepsize / weight) * step.float()
+        if self.momentum:
+            if task not in self.velocity:
+                self.velocity[task] = torch.zeros_like(move)
+            velocity = self.velocity[task]
+            velocity.mul_(self.momentum).add_(move)
+            if self.nesterov:
+                move = move + self.momentum * velocity
+            else:
+                move = velocity
+        particles += move.to(particles.dtype)
+        if self.adaptive and task == 'train':
+            self.last_move = move.clone()
+
+    def state_dict(self):
+        # copies, since the tensors keep being updated in place while a
+        # checkpoint is written in the background, and .cpu() is a no-op on
+        # cpu
+        def snapshot(value):
+            return None if value is None else value.detach().cpu().clone()
+        return {'stepsize': self.stepsize,
+                'velocity': {task: snapshot(value)
+                             for (task, value) in self.velocity.items()},
+                'last_move': snapshot(self.last_move),
+                'last_direction': snapshot(self.last_direction)}
+
+    def load_state_dict(self, state, device='cpu'):
+        def to_device(value):
+            return None if value is None else value.to(device)
+        self.stepsize = state['stepsize']
+        self.velocity = {task: to_device(value)
+                         for (task, value) in state['velocity'].items()}
+        self.last_move = to_device(state['last_move'])
+        self.last_direction = to_device(state['last_direction'])
+
+
+class EarlyStopping:
+    """Tells when the loss stopped improving: this is the case when it
+    didn't get below (1 - tolerance) times its best value during `patience`
+    epochs."""
+
+    def __init__(self, tolerance, patience=20):
+        """
+        tolerance: float
+            minimum relative improvement of the loss. 0 means never stop.
+        patience: int
+            number of epochs to wait for an improvement
+        """
+        self.tolerance = tolerance
+        self.patience = patience
+        self.best = None
+        self.waited = 0
+
+    def __call__(self, loss):
+        """ records the loss of an epoch, and returns whether to stop"""
+        if self.tolerance <= 0:
+            return False
+        loss = float(loss)
+        if self.best is None or loss < (1 - self.tolerance) * self.best:
+            self.best = loss
+            self.waited = 0
+            return False
+        self.waited += 1
+        return self.waited >= self.patience
+
+    def state_dict(self):
+        return {'best': self.best, 'waited': self.waited}
+
+    def load_state_dict(self, state):
+        self.best = state['best']
+        self.waited = state['waited']
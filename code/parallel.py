@@ -0,0 +1,203 @@
+# data-parallel sliced Wasserstein flow over shards of particles
+import queue
+import traceback
+import torch
+import torch.multiprocessing as mp
+from math import sqrt
+import engine
+
+# seconds between the checks that the workers are alive, while waiting
+POLL_INTERVAL = 1
+
+
+def shard_worker(rank, shard, percentiles, merge_percentiles, local_qf,
+                 chunk_size, num_threads, seed, commands, results):
+    """Process transporting one shard of the particles.
+
+    Each epoch comes in two phases. With a ('project', thetas) command, the
+    shard is projected and its quantiles at `merge_percentiles` are written
+    to local_qf[rank]. With a ('transport', target_qf, global_qf, stepsize,
+    regularization) command, the shard is transported with the global
+    quantiles, and updated in place. If chunk_size is given, the shard is
+    processed by chunks in both phases. After each command, (rank, None)
+    is put on `results`, or (rank, traceback) if it failed, after which
+    the worker stops."""
+    torch.set_num_threads(num_threads)
+    torch.manual_seed(seed)
+    slice_step = engine.SliceStep(percentiles, dtype=shard.dtype,
+                                  chunk_size=chunk_size,
+                                  num_merge_quantiles=len(merge_percentiles))
+    for command in iter(commands.get, None):
+        try:
+            if command[0] == 'project':
+                thetas = command[1]
+                thetas = thetas.view(-1, thetas.shape[-1])
+                with torch.no_grad():
+                    if chunk_size is None:
+                        projections = slice_step.project(shard, thetas)
+                        local_qf[rank] = slice_step.quantiles(
+                            projections, merge_percentiles)
+                    else:
+                        local_qf[rank] = slice_step.summary(shard, thetas)
+            elif command[0] == 'transport':
+                (_, target_qf, global_qf, stepsize, regularization) = command
+                target_qf = target_qf.view(thetas.shape[0], -1)
+                with torch.no_grad():
+                    if chunk_size is None:
+                        transported = slice_step.reference_transport(
+                            projections, target_qf, global_qf)
+                        displacement = slice_step.backproject(
+                            transported, projections, thetas)
+                    else:
+                        displacement = slice_step.transport(
+                            shard, thetas, target_qf, global_qf)
+                    shard += (stepsize / thetas.shape[0]
+                              * displacement.view(shard.shape))
+                    if regularization:
+                        noise = torch.randn(*shard.shape)
+                        noise /= sqrt(shard.shape[-1])
+                        shard += regularization * noise
+        except Exception:
+            # the error is given back to the flow, that stops
+            results.put((rank, traceback.format_exc()))
+            return
+        results.put((rank, None))
+
+
+class ShardedFlow:
+    """Sliced Wasserstein Flow over particles split across processes.
+
+    The particles are put in shared memory and split into shards, each of
+    them handled by a worker process that projects and transports it. The
+    transport needs the quantiles of all the particles: the workers compute
+    the quantiles of their shard on a fine grid, and these are merged into
+    the global quantiles before the transport."""
+
+    def __init__(self, particles, percentiles, num_workers,
+                 num_merge_quantiles=None, chunk_size=None, seed=0):
+        """
+        particles: Tensor (num_particles, ...)
+            the particles, on cpu. They are moved to shared memory and
+            updated in place.
+        percentiles: Tensor (num_quantiles,)
+            the percentiles of the target quantiles
+        num_workers: int
+            number of processes
+        num_merge_quantiles: int or None
+            number of quantiles computed on each shard for the merge.
+            Defaults to four times the number of percentiles.
+        chunk_size: int or None
+            if given, the workers process their shard by chunks of that size
+        seed: int
+            seed for the noise of the workers
+        """
+        if particles.device.type != 'cpu':
+            raise ValueError('Sharded flows only work with cpu particles')
+        self.particles = particles.share_memory_()
+        self.percentiles = percentiles.cpu()
+        if num_merge_quantiles is None:
+            num_merge_quantiles = 4 * len(percentiles)
+        self.merge_percentiles = torch.linspace(0, 100, num_merge_quantiles)
+        self.shards = particles.chunk(num_workers)
+        self.counts = [len(shard) for shard in self.shards]
+        self.local_qf = None
+        self.chunk_size = chunk_size
+        self.num_threads = max(1, torch.get_num_threads() // num_workers)
+        self.seed = seed
+        self.commands = []
+        self.results = mp.Queue()
+        self.workers = []
+        self.shared = {}
+
+    def start(self, num_projections):
+        """ starts the workers, with buffers for num_projections"""
+        self.close()
+        self.local_qf = torch.zeros(len(self.shards),
+                                    len(self.merge_percentiles),
+                                    num_projections).share_memory_()
+        self.commands = [mp.Queue() for shard in self.shards]
+        self.workers = [
+            mp.Process(target=shard_worker,
+                       args=(rank, shard, self.percentiles,
+                             self.merge_percentiles, self.local_qf,
+                             self.chunk_size, self.num_threads,
+                             self.seed + rank, self.commands[rank],
+                             self.results),
+                       daemon=True)
+            for (rank, shard) in enumerate(self.shards)]
+        for worker in self.workers:
+            worker.start()
+
+    def share(self, name, tensor):
+        """returns a copy of tensor in shared memory. The copy is reused as
+        long as the same tensor is given, so that fixed sketches are shared
+        with the workers only once. Structured thetas, like those of
+        projection.SRHTStack, are small and only moved to the cpu."""
+        if name not in self.shared or self.shared[name][0] is not tensor:
+            copy = (tensor.detach().cpu().clone().share_memory_()
+                    if torch.is_tensor(tensor) else tensor.to('cpu'))
+            self.shared[name] = (tensor, copy)
+        return self.shared[name][1]
+
+    def run(self, *command):
+        """ sends a command to all workers and waits for them. If a worker
+        fails or dies, the workers are stopped and a RuntimeError is
+        raised."""
+        for commands in self.commands:
+            commands.put(command)
+        for _ in self.workers:
+            (rank, error) = self.result()
+            if error is not None:
+                self.close()
+                raise RuntimeError('flow worker %d failed:\n%s'
+                                   % (rank, error))
+
+    def result(self):
+        """ waits for the result of a worker, checking that they are all
+        alive"""
+        while True:
+            try:
+                return self.results.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                for (rank, worker) in enumerate(self.workers):
+                    if not worker.is_alive():
+                        self.close()
+                        raise RuntimeError(
+                            'flow worker %d died with exit code %s'
+                            % (rank, worker.exitcode))
+
+    def step(self, thetas, target_qf, stepsize, regularization):
+        """Applies one step of the flow to all the shards.
+
+        thetas: Tensor (num_sketches, num_thetas, dim)
+        target_qf: Tensor (num_sketches, num_thetas, num_quantiles)
+
+        returns (particles_qf, loss) with particles_qf the merged quantiles
+        of the particles before the step, as (num_quantiles,
+        num_sketches*num_thetas), and loss the corresponding sliced loss."""
+        num_projections = thetas.shape[0] * thetas.shape[1]
+        if (self.local_qf is None
+                or self.local_qf.shape[-1] != num_projections):
+            self.start(num_projections)
+        thetas = self.share('thetas', thetas)
+        target_qf = self.share('target_qf', target_qf)
+
+        # all-reduce of the quantiles
+        self.run('project', thetas)
+        particles_qf = engine.merge_quantiles(
+            self.local_qf, self.counts, self.percentiles).contiguous()
+        loss = engine.sliced_loss(particles_qf,
+                                  target_qf.view(num_projections, -1),
+                                  thetas.shape[0])
+
+        self.run('transport', target_qf, particles_qf, stepsize,
+                 regularization)
+        return (particles_qf, loss)
+
+    def close(self):
+        for commands in self.commands:
+            commands.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.commands = []
+        self.workers = []
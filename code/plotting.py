@@ -6,15 +6,18 @@ from matplotlib.cm import get_cmap
 import matplotlib.ticker as ticker
 import matplotlib.patches as mpatches
 import torch
-from torch.utils.data import DataLoader
+from data import get_batch, iterate_batches
 from torchvision.utils import make_grid
 import torch.multiprocessing as mp
+from torchpercentile import Percentile
 import numpy as np
 from math import floor
 import tqdm
 import os
+import queue
 import matplotlib as mpl
 import pandas as pd
+import engine
 
 mpl.rcParams['savefig.pad_inches'] = 0
 mpl.rcParams['pdf.fonttype'] = 42
@@ -71,31 +74,144 @@ def add_plotting_arguments(parser):
                         help="If active, will not display the SW cost over "
                              "iterations",
                         action="store_true")
+    parser.add_argument("--async_plot",
+                        help="If active, the plots are rendered by a "
+                             "separate process, so that the flow doesn't "
+                             "wait for them",
+                        action="store_true")
+    parser.add_argument("--plot_queue_size",
+                        help="Maximum number of snapshots waiting to be "
+                             "rendered with --async_plot. Older ones are "
+                             "dropped beyond this.",
+                        type=int,
+                        default=2)
+    parser.add_argument("--nn_index_dir",
+                        help="Directory where the index for finding the "
+                             "closest entries of the dataset is cached. "
+                             "Defaults to the plot directory.")
+    parser.add_argument("--density_cache_dir",
+                        help="If provided, the densities of the data for "
+                             "the density plots are cached in this "
+                             "directory")
     return parser
 
 
-def find_closest(items, dataset):
-    """ find the indices of the entries of the dataset that are closest
-    to the provided items"""
-    # bring the items to cpu and flatten them
-    items = items.detach().cpu()
-    num = items.shape[0]
-    items = items.view(num, -1)
-
-    # initialize the losses to infinite
-    mindist = torch.ones(num)*float('inf')
-    closest = torch.zeros_like(items)
-    num_workers = max(1, floor((mp.cpu_count()-2)/2))
-    dataloader = DataLoader(dataset, batch_size=5000, num_workers=num_workers)
-    for (candidates, _) in dataloader:
-        candidates = candidates.view(candidates.shape[0], -1).cpu()
-        distances = torch.norm(
-                        items[:, None, :] - candidates[None, ...],
-                        dim=-1)
-        mindist_in_batch, closest_in_batch = torch.min(distances, dim=1)
-        replace = torch.nonzero(mindist_in_batch < mindist)
-        closest[replace] = candidates[closest_in_batch[replace]]
-    return closest
+def log_schedule(epoch, plot_every, plot_epochs, match_every):
+    """ returns (plot, match), telling whether we need to plot and/or look
+    for the closest entries in the dataset at this epoch"""
+    match = (match_every > 0
+             and epoch > 0 and not epoch % match_every)
+    plot = ((plot_epochs is None
+             and (plot_every > 0 and not epoch % plot_every))
+            or (plot_epochs is not None and epoch in plot_epochs)
+            )
+    return (plot, match)
+
+
+class NearestNeighbors:
+    """Exact nearest neighbours search among the entries of a dataset.
+
+    Distances to the queries are computed by blocks of entries with the
+    ||a||^2 + ||b||^2 - 2ab form, so that each block is a single GEMM, and
+    the squared norms of the entries are computed once. The entries are
+    read block after block, so that the memory needed doesn't grow with
+    the dataset.
+
+    Datasets with a get_batch method, like the memory-mapped ones, are
+    searched in place. For other datasets, if a filename is given, the
+    flattened entries are stored there once as a float32 .npy file, that
+    is memory-mapped by the next runs. Otherwise, they are streamed from
+    the dataset at each search. The norms are stored along the filename.
+    """
+
+    def __init__(self, dataset, filename=None, block_size=5000):
+        """
+        dataset: dataset
+            the dataset to search in
+        filename: string or None
+            .npy file where to cache the index
+        block_size: int
+            number of entries to compare with at once
+        """
+        self.dataset = dataset
+        self.block_size = block_size
+        self.num_workers = max(1, floor((mp.cpu_count()-2)/2))
+        self.item_shape = dataset[0][0].shape
+        self.items = None
+        copy = filename is not None and not hasattr(dataset, 'get_batch')
+        norms_filename = (None if filename is None
+                          else filename[:-len('.npy')] + '_norms.npy')
+        if (norms_filename is not None and os.path.exists(norms_filename)
+                and (not copy or os.path.exists(filename))):
+            if copy:
+                self.items = torch.from_numpy(np.load(filename,
+                                                      mmap_mode='c'))
+            self.norms = torch.from_numpy(np.load(norms_filename))
+            return
+
+        print('Building the nearest neighbours index')
+        dim = int(np.prod(self.item_shape))
+        if copy:
+            directory = os.path.dirname(filename)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            items = np.lib.format.open_memmap(
+                filename, mode='w+', dtype=np.float32,
+                shape=(len(dataset), dim))
+        norms = np.zeros(len(dataset), dtype=np.float32)
+        start = 0
+        for candidates in tqdm.tqdm(self.blocks(),
+                                    total=-(-len(dataset) // block_size)):
+            end = start + candidates.shape[0]
+            if copy:
+                items[start:end] = candidates.numpy()
+            norms[start:end] = (candidates**2).sum(dim=1).numpy()
+            start = end
+        if copy:
+            items.flush()
+            self.items = torch.from_numpy(items)
+        if norms_filename is not None:
+            directory = os.path.dirname(norms_filename)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            # the norms are written last, and mark the index as complete
+            np.save(norms_filename, norms)
+        self.norms = torch.from_numpy(norms)
+
+    def blocks(self):
+        """ yields the flattened entries of the dataset as float32 cpu
+        tensors, by blocks of block_size"""
+        if self.items is not None:
+            for start in range(0, self.items.shape[0], self.block_size):
+                yield self.items[start:start + self.block_size]
+            return
+        for candidates in iterate_batches(self.dataset, self.block_size,
+                                          self.num_workers):
+            yield candidates.reshape(candidates.shape[0], -1).cpu().float()
+
+    def __call__(self, items):
+        """ returns the entries of the dataset that are closest to the
+        provided items"""
+        # bring the items to cpu and flatten them
+        items = items.detach().cpu().float()
+        num = items.shape[0]
+        items = items.view(num, -1)
+
+        mindist = torch.ones(num)*float('inf')
+        closest = torch.zeros(num, items.shape[1])
+        start = 0
+        for candidates in self.blocks():
+            end = start + candidates.shape[0]
+            # the norm of the items is the same for all candidates
+            distances = (self.norms[None, start:end]
+                         - 2 * torch.mm(items, candidates.t()))
+            (mindist_in_block, closest_in_block) = torch.min(distances,
+                                                             dim=1)
+            replace = mindist_in_block < mindist
+            mindist[replace] = mindist_in_block[replace]
+            closest[replace] = candidates[closest_in_block[replace]]
+            start = end
+        return closest.view(num, *self.item_shape)
 
 
 def plot_function(data, axes, markers='r.'):
@@ -140,6 +256,77 @@ def plot_function(data, axes, markers='r.'):
     return newplots
 
 
+def kde_bandwidths(data):
+    """ Scott's rule bandwidths for bivariate kdes, for each column of a
+    (num_samples, num_features) array"""
+    return np.maximum(1e-5, np.std(data, axis=0)) * len(data) ** (-1. / 6)
+
+
+def kde_grids(data, bandwidths, gridsize=100, cut=3):
+    """ returns a (num_features, gridsize) array with the positions of the
+    grid for each column of data, spanning cut bandwidths beyond the data"""
+    return np.linspace(data.min(axis=0) - cut * bandwidths,
+                       data.max(axis=0) + cut * bandwidths,
+                       gridsize).T
+
+
+def pairwise_kde(data, grids, bandwidths, pairs):
+    """Bivariate gaussian kdes of pairs of columns of data.
+
+    All pairs are computed in one vectorized pass: the samples are binned on
+    the grids, and the histograms are convolved with the gaussian kernels
+    through FFTs. Samples out of the grids are ignored.
+
+    data: (num_samples, num_features) array
+    grids: (num_features, gridsize) array, as given by kde_grids
+    bandwidths: (num_features,) array
+    pairs: list of (x feature, y feature) tuples
+
+    returns a (num_pairs, gridsize, gridsize) array, whose entry [p, i, j]
+    is the density of pair p at (grids[x][i], grids[y][j])."""
+    (num_features, gridsize) = grids.shape
+    steps = grids[:, 1] - grids[:, 0]
+    bins = np.rint((data - grids[None, :, 0]) / steps[None, :]).astype(int)
+    inside = (bins >= 0) & (bins < gridsize)
+
+    # 2-D histograms of all pairs at once
+    (x, y) = (np.array([pair[0] for pair in pairs], dtype=int),
+              np.array([pair[1] for pair in pairs], dtype=int))
+    valid = inside[:, x] & inside[:, y]
+    flat = (np.arange(len(pairs))[None, :] * gridsize**2
+            + bins[:, x] * gridsize + bins[:, y])
+    hist = np.bincount(flat[valid], minlength=len(pairs) * gridsize**2)
+    hist = hist.reshape(len(pairs), gridsize, gridsize).astype(np.float64)
+
+    # gaussian kernels of each feature, on zero-padded grids
+    size = 2 * gridsize
+    offsets = np.arange(size)
+    offsets = np.where(offsets < gridsize, offsets, offsets - size)
+    sigmas = np.maximum(1e-3, bandwidths / steps)
+    kernels = np.exp(-0.5 * (offsets[None, :] / sigmas[:, None])**2)
+    kernels /= kernels.sum(axis=1, keepdims=True)
+
+    spectrum = np.fft.rfft2(hist, s=(size, size))
+    spectrum *= (np.fft.fft(kernels[x])[:, :, None]
+                 * np.fft.rfft(kernels[y])[:, None, :])
+    densities = np.fft.irfft2(spectrum, s=(size, size))[:, :gridsize,
+                                                        :gridsize]
+    densities /= (len(data) * steps[x] * steps[y])[:, None, None]
+    return np.maximum(densities, 0)
+
+
+def plot_kde(ax, xgrid, ygrid, density, nlevels, cmap, shade):
+    """draws the contours of a density computed on a grid. As for seaborn,
+    the lowest level is not drawn."""
+    if not density.max() > 0:
+        return
+    levels = np.linspace(0, density.max(), nlevels)[1:]
+    if shade:
+        ax.contourf(xgrid, ygrid, density.T, levels=levels, cmap=cmap)
+    else:
+        ax.contour(xgrid, ygrid, density.T, levels=levels, cmap=cmap)
+
+
 class SWFPlot:
     """ some big dirty class with just plotting stuff"""
     def __init__(self, features, dataset, plot_dir,
@@ -147,8 +334,10 @@ class SWFPlot:
                  no_closest_plot=False, no_swcost_plot=False,
                  plot_every=1, plot_epochs=None, match_every=1000,
                  plot_num_train=104, plot_num_test=None,
-                 decode_fn=None, make_titles=True,
-                 dpi=200, basefilename='', extension='png'):
+                 swcost_thetas=None, swcost_num_examples=5000,
+                 decode_fn=None, make_titles=True, nn_index_file=None,
+                 density_cache_file=None, dpi=200, basefilename='',
+                 extension='png'):
         """
         Initialize the plotting class
 
@@ -170,10 +359,21 @@ class SWFPlot:
         plot_num_test: int or None
             number of test samples to plot (use -1 for all). If None, will
             do the same as plot_num_train
+        swcost_thetas: Tensor (num_thetas, dim), structured thetas or None
+            thetas of a projector that the flow doesn't use, on which the
+            SW cost is measured. The SW cost is not plotted if None.
+        swcost_num_examples: int
+            number of items of the dataset sketched on swcost_thetas
         decode_fn: function or None
             if not None, the features are sent there for plotting
         make_titles: boolean
             whether or not to write titles on the figures
+        nn_index_file: string or None
+            .npy file where to cache the index for finding the closest
+            entries of the dataset. If None, datasets without get_batch
+            are read again at each search.
+        density_cache_file: string or None
+            .npz file where to cache the densities of the data
         dpi: int
             dpi for the figures
         basefilename: string
@@ -186,7 +386,7 @@ class SWFPlot:
         self.density_plot = not no_density_plot
         self.particles_plot = not no_particles_plot
         self.closest_plot = not no_closest_plot
-        self.swcost_plot = not no_swcost_plot
+        self.swcost_plot = not no_swcost_plot and swcost_thetas is not None
 
         self.plot_every = plot_every
         self.plot_epochs = plot_epochs
@@ -203,12 +403,19 @@ class SWFPlot:
         self.extension = extension
         self.basefilename = basefilename
         self.plots_to_purge = []
+        self.nn_index_file = nn_index_file
+        self.neighbors = None
 
         self.axes = {}
         self.figs = {}
         self.updated = []
         # initialize the figures if needed
         if self.density_plot:
+            # pairs of features of the density plots, as indices in
+            # self.features. Pair (col, row+1) is at position
+            # row*(row+1)/2 + col
+            self.density_pairs = [(col, row+1) for row in range(self.ndim - 1)
+                                  for col in range(row+1)]
             self.density_nlevels = 10
             self.density_data_palette = get_cmap("Blues")
             self.density_train_palette = get_cmap("copper")
@@ -218,28 +425,48 @@ class SWFPlot:
             fig.clf()
 
             # prepare the heat map of the distribution of the data
-            train_loader = DataLoader(dataset,
-                                      batch_size=min(5000, len(dataset)))
-            data = next(iter(train_loader))[0].squeeze().cpu().numpy()
-            data = data.reshape((data.shape[0], -1))
-
-            std_data = np.std(data, axis=0)
-            data += (np.random.randn(*data.shape)
-                     * np.maximum(1e-5,
-                                  std_data[None, :]/100))
-            if isinstance(features, int) and features == data.shape[1]:
-                self.features = range(self.features)
-            elif isinstance(features, int) and features > data.shape[1]:
-                raise Exception('There are less features than those asked for')
-            elif isinstance(features, int) and features <= data.shape[1]:
-                # picking the most energetic features
-                self.features = np.argsort(std_data)[-self.ndim:][::-1]
+            if (density_cache_file is not None
+                    and os.path.exists(density_cache_file)):
+                cache = np.load(density_cache_file)
+                self.features = cache['features']
+                self.density_grids = cache['grids']
+                data_densities = cache['densities']
+            else:
+                data = get_batch(dataset, slice(0, min(5000, len(dataset))))
+                data = data.squeeze().cpu().float().numpy()
+                data = data.reshape((data.shape[0], -1))
+
+                std_data = np.std(data, axis=0)
+                data += (np.random.randn(*data.shape)
+                         * np.maximum(1e-5,
+                                      std_data[None, :]/100))
+                if isinstance(features, int) and features == data.shape[1]:
+                    self.features = np.arange(self.features)
+                elif isinstance(features, int) and features > data.shape[1]:
+                    raise Exception(
+                        'There are less features than those asked for')
+                elif isinstance(features, int) and features <= data.shape[1]:
+                    # picking the most energetic features
+                    self.features = np.argsort(std_data)[-self.ndim:][::-1]
+                self.features = np.array(self.features)
+                data = data[:, self.features]
+                bandwidths = kde_bandwidths(data)
+                self.density_grids = kde_grids(data, bandwidths)
+                data_densities = pairwise_kde(data, self.density_grids,
+                                              bandwidths, self.density_pairs)
+                if density_cache_file is not None:
+                    directory = os.path.dirname(density_cache_file)
+                    if directory and not os.path.exists(directory):
+                        os.makedirs(directory)
+                    tmp_filename = density_cache_file + '.tmp.npz'
+                    np.savez(tmp_filename, features=self.features,
+                             grids=self.density_grids,
+                             densities=data_densities)
+                    os.replace(tmp_filename, density_cache_file)
 
             self.axes['density'] = []
             self.density_xlim = []
             self.density_ylim = []
-            print('Preparing the density plots of figures... may take a while')
-            pbar = tqdm.tqdm(total=(self.ndim - 1)*self.ndim/2)
             for row in range(self.ndim - 1):
                 row_axes = []
                 row_xlim = []
@@ -248,14 +475,11 @@ class SWFPlot:
                     ax = plt.subplot(self.ndim-1, self.ndim-1,
                                      row*(self.ndim-1)+col+1)
                     with sb.axes_style("whitegrid"):
-                        sb.kdeplot(
-                            data=data[:, self.features[col]],
-                            data2=data[:, self.features[row+1]],
-                            gridsize=100, n_levels=self.density_nlevels,
-                            shade=True,
-                            shade_lowest=False,
-                            cmap=self.density_data_palette,
-                            ax=ax)
+                        plot_kde(ax, self.density_grids[col],
+                                 self.density_grids[row+1],
+                                 data_densities[self.density_pair(row, col)],
+                                 self.density_nlevels,
+                                 self.density_data_palette, shade=True)
                         ax.tick_params(
                             axis='both',
                             which='both',
@@ -282,7 +506,6 @@ class SWFPlot:
                                  'feature %d' % self.features[col],
                                  transform=ax.transAxes,
                                  horizontalalignment='center')
-                    pbar.update(1)
                 if self.ndim > 2:
                     plt.text(1+(self.ndim-1)/40, 0.5,
                              'feature %d' % self.features[row+1], rotation=90,
@@ -351,9 +574,33 @@ class SWFPlot:
             self.figs['swcost'].set_size_inches(10, 3)
             plt.subplots_adjust(wspace=0.05, hspace=0.05)
             self.updated += ['swcost']
+            self.swcost_thetas = swcost_thetas
+            # the items of the dataset whose sketch is the target, computed
+            # at the first plot
+            generator = torch.Generator().manual_seed(0)
+            self.swcost_indices = torch.randperm(
+                len(dataset), generator=generator)[:swcost_num_examples]
+            self.swcost_target_qf = None
 
         self.save_figs('init')
 
+    @staticmethod
+    def density_pair(row, col):
+        """ index of the density plot at (row, col) in density_pairs"""
+        return row * (row + 1) // 2 + col
+
+    def swcost_quantiles(self, items, percentiles):
+        """ quantiles of the (num_items, ...) items projected on the thetas
+        of the SW cost, that are moved to the device of the items. These
+        thetas may be structured, like a projection.SRHTStack. returns
+        a (num_quantiles, num_thetas) Tensor"""
+        if self.swcost_thetas.device != items.device:
+            self.swcost_thetas = self.swcost_thetas.to(items.device)
+        with torch.no_grad():
+            projections = engine.project(
+                items.view(items.shape[0], -1).float(), self.swcost_thetas)
+            return Percentile()(projections, percentiles.to(projections))
+
     def save_figs(self, filename):
         # create the folder if it doesn't exist
         if not os.path.exists(self.plot_dir):
@@ -375,19 +622,15 @@ class SWFPlot:
 
     def log(self, vars, epoch):
         # checking whether we need to match and/or plot
-        match = (self.match_every > 0
-                 and epoch > 0 and not epoch % self.match_every)
-        plot = ((self.plot_epochs is None
-                 and (self.plot_every > 0 and not epoch % self.plot_every))
-                or (self.plot_epochs is not None and epoch in self.plot_epochs)
-                )
+        (plot, match) = log_schedule(epoch, self.plot_every,
+                                     self.plot_epochs, self.match_every)
         if not plot and not match:
             # nothing to do
             return
 
         # convert the particles to cpu
-        train = vars['particles']['train'].to('cpu')
-        test = (vars['particles']['test'].to('cpu')
+        train = vars['particles']['train'].to('cpu').float()
+        test = (vars['particles']['test'].to('cpu').float()
                 if 'test' in vars['particles']
                 else None)
 
@@ -395,9 +638,13 @@ class SWFPlot:
         new_plots = []
         self.updated = []
         if 'density' in self.figs:
-            train_plot = train.squeeze().view(train.shape[0], -1)
+            train_plot = train.view(train.shape[0], -1).numpy()
+            train_plot = train_plot[:, self.features]
             # plot the actual values of the particles over density plots,
             # just doing this for train particles
+            train_densities = pairwise_kde(train_plot, self.density_grids,
+                                           kde_bandwidths(train_plot),
+                                           self.density_pairs)
             for row in range(self.ndim - 1):
                 for col in range(row+1):
                     ax = self.axes['density'][row][col]
@@ -405,15 +652,11 @@ class SWFPlot:
                     with sb.axes_style("whitegrid"):
                         ax.set_xlim(*self.density_xlim[row][col])
                         ax.set_ylim(*self.density_ylim[row][col])
-                        sb.kdeplot(
-                            data=(train_plot[:, self.features[col]]
-                                  .cpu().numpy()),
-                            data2=(train_plot[:, self.features[row+1]]
-                                   .cpu().numpy()),
-                            gridsize=100, n_levels=self.density_nlevels,
-                            shade=False,
-                            cmap=self.density_train_palette,
-                            ax=ax)
+                        plot_kde(ax, self.density_grids[col],
+                                 self.density_grids[row+1],
+                                 train_densities[self.density_pair(row, col)],
+                                 self.density_nlevels,
+                                 self.density_train_palette, shade=False)
                         ax.xaxis.set_major_locator(
                             ticker.LinearLocator(numticks=5))
                         ax.yaxis.set_major_locator(
@@ -466,9 +709,11 @@ class SWFPlot:
                 self.updated += ['particles_test']
 
         if 'closest' in self.figs and match:
-            closest = find_closest(
-                        vars['particles']['train'][:self.plot_num_train],
-                        self.dataset)
+            if self.neighbors is None:
+                self.neighbors = NearestNeighbors(self.dataset,
+                                                  self.nn_index_file)
+            closest = self.neighbors(
+                        vars['particles']['train'][:self.plot_num_train])
             if self.decode_fn is not None:
                 closest = self.decode_fn(closest)
             new_plots_tmp = plot_function(
@@ -486,30 +731,26 @@ class SWFPlot:
                 new_plots += new_plots_tmp
                 self.updated += ['closest']
         if 'swcost' in self.figs:
-            sketcher = vars['sketcher']
+            # SW cost on the held-out thetas, whose data sketch is computed
+            # once
+            device = vars['particles']['train'].device
+            if self.swcost_target_qf is None:
+                self.swcost_target_qf = self.swcost_quantiles(
+                    get_batch(self.dataset, self.swcost_indices).to(device),
+                    vars['percentiles'])
             self.nswcost_plotted += 1
-            import copy
-            # doing a copy of the module, because we are going to move it to
-            # another device, and this is a reference to the module of the
-            # project
-            swmodule = copy.deepcopy(
-                            vars['projector_modules'][
-                                np.random.randint(100000)])
             for task in vars['particles']:
-                particles = vars['particles'][task].clone().detach()
-                with torch.no_grad():
-                    particles_qf = sketcher(swmodule.to(particles.device),
-                                            particles)
-                    target_qf = sketcher[swmodule.cpu()]
-                errors = (particles_qf.cpu() - target_qf.cpu())**2
-                errors = errors.mean(dim=1).detach().numpy()
+                particles_qf = self.swcost_quantiles(
+                    vars['particles'][task], vars['percentiles'])
+                errors = (particles_qf - self.swcost_target_qf)**2
+                errors = errors.mean(dim=0).cpu().numpy()
                 errors = 20*np.log10(errors)
                 new_errors = pd.DataFrame(
                         {'iteration': (np.ones(errors.shape)
                                        * epoch).astype(int),
                          'task': [task, ]*len(errors),
                          'SW loss (dB)': errors})
-                self.swcost = self.swcost.append(new_errors)
+                self.swcost = pd.concat((self.swcost, new_errors))
             fig = self.figs['swcost']
             fig.clf()
             ax = fig.gca()
@@ -533,3 +774,68 @@ class SWFPlot:
 
         self.save_figs(filename='%04d' % epoch)
         self.plots_to_purge = new_plots
+
+
+def render(plot_kwargs, snapshots):
+    """ process rendering the snapshots of the flow with a SWFPlot"""
+    plt.switch_backend('Agg')
+    plotter = SWFPlot(**plot_kwargs)
+    for (vars, epoch) in iter(snapshots.get, None):
+        plotter.log(vars, epoch)
+
+
+class AsyncSWFPlot:
+    """Plots of the flow, rendered by a separate process.
+
+    `log` only takes a cpu snapshot of the particles, and hands it to a
+    process that owns a SWFPlot and renders it. If the renderer falls
+    behind, the oldest waiting snapshot is dropped."""
+
+    def __init__(self, queue_size=2, **plot_kwargs):
+        """
+        queue_size: int
+            maximum number of snapshots waiting to be rendered
+        plot_kwargs:
+            the parameters of the SWFPlot
+        """
+        self.plot_every = plot_kwargs.get('plot_every', 1)
+        self.plot_epochs = plot_kwargs.get('plot_epochs', None)
+        self.match_every = plot_kwargs.get('match_every', 1000)
+        self.num_dropped = 0
+        self.snapshots = mp.Queue(maxsize=queue_size)
+        self.renderer = mp.Process(target=render,
+                                   args=(plot_kwargs, self.snapshots))
+        self.renderer.start()
+
+    def log(self, vars, epoch):
+        (plot, match) = log_schedule(epoch, self.plot_every,
+                                     self.plot_epochs, self.match_every)
+        if not plot and not match:
+            return
+
+        # the thetas of the SW cost were given to the renderer with the
+        # plot parameters: only the particles are copied
+        snapshot = {'particles': {task: value.detach().cpu().clone()
+                                  for (task, value)
+                                  in vars['particles'].items()},
+                    'percentiles': vars['percentiles'].cpu()}
+
+        try:
+            self.snapshots.put_nowait((snapshot, epoch))
+        except queue.Full:
+            # the renderer is late: drop the oldest snapshot
+            try:
+                self.snapshots.get_nowait()
+                self.num_dropped += 1
+            except queue.Empty:
+                pass
+            self.snapshots.put((snapshot, epoch))
+
+    def close(self):
+        """ waits for the renderer to finish the remaining snapshots. If it
+        died, there is nothing to wait for."""
+        if self.renderer.is_alive():
+            self.snapshots.put(None)
+        self.renderer.join()
+        if self.num_dropped:
+            print('%d plot snapshots were dropped' % self.num_dropped)
@@ -0,0 +1,186 @@
+# timers, counters and memory usage of the sliced Wasserstein flow
+import os
+import json
+import time
+import resource
+import torch
+
+
+def add_profiling_arguments(parser):
+    parser.add_argument("--profile",
+                        help="If provided, the time spent in each stage of "
+                             "the flow is written to this file. Files "
+                             "ending with .jsonl get one summary line per "
+                             "epoch, others get a Chrome trace, to be "
+                             "opened with chrome://tracing.")
+    return parser
+
+
+class NullSection:
+    """ section that does nothing, for disabled profilers"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SECTION = NullSection()
+
+
+class NullProfiler:
+    """ profiler that does nothing. This is what the flow uses when no
+    profiling is asked for, so that it costs nothing."""
+
+    def section(self, name):
+        return NULL_SECTION
+
+    def count(self, name, value=1):
+        pass
+
+    def epoch(self, epoch):
+        pass
+
+    def close(self):
+        pass
+
+
+NULL_PROFILER = NullProfiler()
+
+
+def resident_memory():
+    """ current resident memory of the process in bytes, or None if it can
+    not be read, /proc being linux only"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+class Section:
+    """ timed section of a Profiler"""
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler.synchronize()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.synchronize()
+        self.profiler.sample_memory()
+        self.profiler.record(self.name, self.start, time.perf_counter())
+        return False
+
+
+class Profiler:
+    """Named timers and counters for the flow.
+
+    Stages are timed with `with profiler.section(name):`, and counters are
+    incremented with `profiler.count(name, value)`. At the end of each
+    epoch, `profiler.epoch(epoch)` sums the time of each stage and the
+    counters over the epoch, together with the peak memory. When the
+    profiler is closed, everything is written to a file: either a Chrome
+    trace, or a structured log with one json line per epoch.
+
+    On cuda, the device is synchronized around each section, so that the
+    timings are those of the computations and not of their launch. On cpu,
+    the resident memory is sampled at the end of each section, so that the
+    peak memory of an epoch is the largest of these samples."""
+
+    def __init__(self, filename, device='cpu'):
+        """
+        filename: string
+            output file. If it ends with .jsonl, a line is written per
+            epoch, otherwise a Chrome trace is written at the end.
+        device: torch.device or string
+            device of the computations
+        """
+        self.filename = os.path.expanduser(filename)
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.device = torch.device(device)
+        self.trace = not self.filename.endswith('.jsonl')
+        self.origin = time.perf_counter()
+        self.events = []
+        self.times = {}
+        self.counters = {}
+        self.log = None if self.trace else open(self.filename, 'w')
+        self.peak_rss = 0
+        if self.device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    def synchronize(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    def sample_memory(self):
+        """ updates the peak resident memory of the epoch, on cpu"""
+        if self.device.type != 'cuda':
+            self.peak_rss = max(self.peak_rss, resident_memory() or 0)
+
+    def section(self, name):
+        """ returns a context manager timing the enclosed code as `name`"""
+        return Section(self, name)
+
+    def record(self, name, start, end):
+        self.times[name] = self.times.get(name, 0) + end - start
+        if self.trace:
+            self.events += [{'name': name, 'ph': 'X', 'pid': os.getpid(),
+                             'tid': 0, 'ts': (start - self.origin) * 1e6,
+                             'dur': (end - start) * 1e6}]
+
+    def count(self, name, value=1):
+        """ adds value to the counter `name`"""
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def peak_memory(self):
+        """ peak memory since the last epoch in bytes: allocated memory on
+        cuda, largest sampled resident memory on cpu. Where the resident
+        memory can not be sampled, this falls back to ru_maxrss, which is
+        the peak over the whole lifetime of the process and not the epoch"""
+        if self.device.type == 'cuda':
+            peak = torch.cuda.max_memory_allocated(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+            return peak
+        self.sample_memory()
+        (peak, self.peak_rss) = (self.peak_rss, 0)
+        if peak:
+            return peak
+        # ru_maxrss is in kilobytes on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def epoch(self, epoch):
+        """ ends an epoch, summing its timers and counters"""
+        summary = {'epoch': epoch, 'times': self.times,
+                   'counters': self.counters,
+                   'peak_memory': self.peak_memory()}
+        if self.trace:
+            ts = (time.perf_counter() - self.origin) * 1e6
+            self.events += [{'name': 'peak_memory', 'ph': 'C',
+                             'pid': os.getpid(), 'ts': ts,
+                             'args': {'bytes': summary['peak_memory']}}]
+            self.events += [{'name': name, 'ph': 'C', 'pid': os.getpid(),
+                             'ts': ts, 'args': {name: value}}
+                            for (name, value) in self.counters.items()]
+        else:
+            self.log.write(json.dumps(summary) + '\n')
+            self.log.flush()
+        self.times = {}
+        self.counters = {}
+
+    def close(self):
+        """ writes the trace, or closes the log"""
+        if self.trace:
+            with open(self.filename, 'w') as f:
+                json.dump({'traceEvents': self.events,
+                           'displayTimeUnit': 'ms'}, f)
+        else:
+            self.log.close()
@@ -0,0 +1,447 @@
+# projections of the particles for the sliced Wasserstein flow
+import math
+from collections import OrderedDict
+import torch
+import qsketch
+
+
+def add_projection_arguments(parser):
+    parser.add_argument("--projector",
+                        help="family of the thetas of each sketch: i.i.d. "
+                             "directions (gaussian), orthonormalized by "
+                             "blocks of the data dimension (orthonormal), "
+                             "quasi Monte Carlo directions (qmc), or rows "
+                             "of structured Hadamard transforms, meant for "
+                             "high dimensions (hadamard). With srht, the "
+                             "thetas are those of subsampled randomized "
+                             "Hadamard transforms, that are applied without "
+                             "storing them as matrices",
+                        choices=sorted(PROJECTORS.keys()),
+                        default='gaussian')
+    parser.add_argument("--orthonormal_thetas",
+                        help="Same as --projector orthonormal",
+                        action="store_true")
+    return parser
+
+
+def qr(matrix):
+    """ reduced QR decomposition, for old and new versions of pytorch"""
+    if hasattr(torch, 'linalg') and hasattr(torch.linalg, 'qr'):
+        return torch.linalg.qr(matrix)
+    return torch.qr(matrix)
+
+
+def orthonormalize(thetas):
+    """orthonormalizes the rows of a (num_thetas, dim) matrix. If there are
+    more thetas than dimensions, this is done by blocks of dim rows."""
+    (num_thetas, dim) = thetas.shape
+    res = torch.empty_like(thetas)
+    for start in range(0, num_thetas, dim):
+        block = thetas[start:start + dim]
+        (q, r) = qr(block.t())
+        # fixing the signs so that the directions stay uniformly distributed
+        signs = torch.sign(torch.diag(r))
+        signs[signs == 0] = 1
+        res[start:start + dim] = (q * signs[None, :]).t()
+    return res
+
+
+class OrthonormalProjector(qsketch.LinearProjector):
+    """Linear projector whose thetas are orthonormal by blocks of the data
+    dimension, instead of i.i.d."""
+
+    def __init__(self, *args, **kwargs):
+        super(OrthonormalProjector, self).__init__(*args, **kwargs)
+        self.weight.data = orthonormalize(self.weight.data)
+
+
+HADAMARD_BLOCK = 128
+hadamard_matrices = {}
+
+
+def hadamard_matrix(size, like):
+    """ normalized (size, size) Hadamard matrix, with the type and device
+    of `like`. The matrices are kept once built."""
+    key = (size, like.dtype, like.device)
+    if key not in hadamard_matrices:
+        matrix = torch.ones(1, 1)
+        while matrix.shape[0] < size:
+            matrix = torch.cat((torch.cat((matrix, matrix), dim=1),
+                                torch.cat((matrix, -matrix), dim=1)))
+        hadamard_matrices[key] = (matrix / math.sqrt(size)).to(like)
+    return hadamard_matrices[key]
+
+
+def hadamard(x):
+    """normalized fast Walsh-Hadamard transform of x along its last
+    dimension, whose size must be a power of 2. The transform is orthogonal
+    and symmetric, so that it is its own inverse.
+
+    The Hadamard matrix is the Kronecker product of smaller ones, of at most
+    HADAMARD_BLOCK rows, that are each applied with a matrix product along
+    their axis. This takes a few passes over the data instead of log2(size)
+    butterflies."""
+    shape = x.shape
+    size = shape[-1]
+    levels = int(math.log2(size))
+    num_factors = max(1, -(-levels // int(math.log2(HADAMARD_BLOCK))))
+    right = size
+    for index in range(num_factors):
+        factor = 2**(levels * (index + 1) // num_factors
+                     - levels * index // num_factors)
+        right //= factor
+        matrix = hadamard_matrix(factor, x)
+        if right == 1:
+            x = torch.mm(x.reshape(-1, factor), matrix)
+        else:
+            x = torch.matmul(matrix, x.reshape(-1, factor, right))
+    return x.reshape(shape)
+
+
+class QMCProjector(qsketch.LinearProjector):
+    """Linear projector whose thetas are quasi Monte Carlo directions: the
+    points of a scrambled Sobol sequence are mapped to gaussian vectors
+    through the inverse of the normal CDF, and then normalized. They cover
+    the sphere more evenly than i.i.d. directions."""
+
+    def __init__(self, *args, **kwargs):
+        super(QMCProjector, self).__init__(*args, **kwargs)
+        (num_thetas, dim) = self.weight.shape
+        # the scrambling is seeded from the torch generator, that the
+        # modules dataset seeds with the id of the projector
+        seed = int(torch.randint(2**31 - 1, (1,)))
+        sobol = torch.quasirandom.SobolEngine(dim, scramble=True, seed=seed)
+        points = sobol.draw(num_thetas).double().clamp(1e-7, 1 - 1e-7)
+        thetas = torch.erfinv(2 * points - 1)
+        thetas /= thetas.norm(dim=1, keepdim=True)
+        self.weight.data = thetas.to(self.weight)
+
+
+class HadamardProjector(qsketch.LinearProjector):
+    """Linear projector whose thetas are rows of structured orthogonal
+    transforms H D3 H D2 H D1, with H the Hadamard transform and the Di
+    random diagonal matrices of signs. The data are padded with zeros up to
+    the next power of 2, and there are as many independent transforms as
+    needed for num_thetas, so that the thetas are orthogonal by blocks.
+
+    forward and backward cost O(D log D) per particle and per block instead
+    of O(D) per theta. The thetas are also materialized as the weight, so
+    that the projector may be used as any linear one. With a few dimensions,
+    these thetas only take a few distinct values: this family is meant for
+    high dimensional data."""
+    num_rounds = 3
+
+    def __init__(self, *args, **kwargs):
+        super(HadamardProjector, self).__init__(*args, **kwargs)
+        (num_thetas, dim) = self.weight.shape
+        size = 2**int(math.ceil(math.log2(dim)))
+        num_blocks = -(-num_thetas // size)
+        self.register_buffer(
+            'signs',
+            torch.randint(2, (num_blocks, self.num_rounds, size)).to(
+                self.weight) * 2 - 1)
+        # the thetas are taken at random among the rows of the last block
+        rows = torch.arange(num_blocks * size)
+        rows[-size:] = (num_blocks - 1) * size + torch.randperm(size)
+        self.register_buffer('rows', rows[:num_thetas])
+        self.register_buffer('norms', torch.ones(num_thetas).to(self.weight))
+        # materializing the thetas, by chunks to save memory
+        thetas = []
+        for start in range(0, num_thetas, size):
+            count = min(size, num_thetas - start)
+            unit = torch.zeros(count, num_thetas).to(self.weight)
+            unit[torch.arange(count), start + torch.arange(count)] = 1
+            thetas += [self.backward(unit)]
+        thetas = torch.cat(thetas)
+        # the zero padding shortens the thetas
+        self.norms = thetas.norm(dim=1)
+        self.weight.data = thetas / self.norms[:, None]
+
+    def forward(self, x):
+        (num_blocks, _, size) = self.signs.shape
+        x = x.view(x.shape[0], -1).to(self.signs)
+        x = torch.nn.functional.pad(x, (0, size - x.shape[1]))
+        x = x[:, None, :].expand(-1, num_blocks, -1)
+        for index in range(self.num_rounds):
+            x = hadamard(x * self.signs[:, index])
+        return x.reshape(x.shape[0], -1)[:, self.rows] / self.norms
+
+    def backward(self, grad):
+        (num_blocks, _, size) = self.signs.shape
+        dim = self.weight.shape[1]
+        x = grad.new_zeros(grad.shape[0], num_blocks * size)
+        x[:, self.rows] = grad / self.norms
+        x = x.view(grad.shape[0], num_blocks, size)
+        for index in reversed(range(self.num_rounds)):
+            x = hadamard(x) * self.signs[:, index]
+        return x.sum(dim=1)[:, :dim]
+
+
+class SRHTProjector(torch.nn.Module):
+    """Projector applying a subsampled randomized Hadamard transform.
+
+    The data are placed at random positions of a vector whose size is the
+    next power of 2, the other entries being zeros. This vector is
+    multiplied by random signs and transformed by H, the Hadamard
+    transform, and num_thetas of the outputs are kept. The thetas are thus
+    random sign vectors of unit norm. They are orthogonal by blocks when the
+    dimension is a power of 2, and nearly so otherwise. When there are more
+    thetas than the size of a transform, several transforms with
+    independent signs are used.
+
+    Only the signs and the indices of the kept outputs are stored, so that
+    a projector takes O(D) memory instead of a (num_thetas, D) matrix, and
+    projecting N particles or going back costs O(N D log D) per block."""
+
+    def __init__(self, input_shape, num_projections):
+        """
+        input_shape: tuple
+            shape of the data
+        num_projections: int
+            number of thetas
+        """
+        super(SRHTProjector, self).__init__()
+        self.dim = int(torch.Size(input_shape).numel())
+        size = 2**int(math.ceil(math.log2(self.dim)))
+        num_blocks = -(-num_projections // size)
+        self.register_buffer(
+            'signs',
+            torch.randint(2, (num_blocks, size)).float() * 2 - 1)
+        self.register_buffer(
+            'rows',
+            torch.cat([block * size + torch.randperm(size)
+                       for block in range(num_blocks)])[:num_projections])
+        self.register_buffer('positions', torch.randperm(size)[:self.dim])
+
+    def thetas(self):
+        """ the thetas as a (num_thetas, dim) SRHTStack"""
+        return SRHTStack(self.signs[None], self.rows[None],
+                         self.positions[None], (len(self.rows), self.dim))
+
+    def forward(self, x):
+        return self.thetas().project(x)
+
+    def backward(self, grad):
+        return self.thetas().backproject(grad)
+
+    @property
+    def weight(self):
+        """ the (num_thetas, dim) matrix of the thetas. It is built on
+        demand, for the code that needs the matrix."""
+        num_thetas = len(self.rows)
+        return self.backward(torch.eye(num_thetas).to(self.signs))
+
+
+class SRHTStack:
+    """Thetas of several SRHT projectors, that stand for the stack of their
+    (num_thetas, dim) matrices without materializing them.
+
+    It has the shape of that stack, and may be viewed with another shape or
+    converted with `to`, as a tensor would. Projecting the particles and
+    going back are done with the fast transforms, sketch after sketch, so
+    that the memory needed is O(N D) for N particles."""
+
+    def __init__(self, signs, rows, positions, shape=None):
+        """
+        signs: Tensor (num_sketches, num_blocks, size)
+            the random signs of the transforms, with size a power of 2
+        rows: Tensor (num_sketches, num_thetas)
+            the outputs kept for each sketch
+        positions: Tensor (num_sketches, dim)
+            the inputs of the transforms where the data are placed
+        shape: tuple or None
+            shape of the stack. Defaults to (num_sketches, num_thetas, dim).
+        """
+        self.signs = signs
+        self.rows = rows
+        self.positions = positions
+        self.dim = positions.shape[-1]
+        if shape is None:
+            shape = rows.shape + (self.dim,)
+        self.shape = torch.Size(shape)
+        # the thetas are the kept rows of H D, cut to the data positions
+        self.scale = math.sqrt(signs.shape[-1] / self.dim)
+
+    @classmethod
+    def cat(cls, stacks):
+        """ stacks the thetas of several SRHTStack"""
+        return cls(torch.cat([stack.signs for stack in stacks]),
+                   torch.cat([stack.rows for stack in stacks]),
+                   torch.cat([stack.positions for stack in stacks]))
+
+    @property
+    def device(self):
+        return self.signs.device
+
+    def view(self, *shape):
+        shape = list(shape)
+        if -1 in shape:
+            known = torch.Size([size for size in shape if size != -1])
+            shape[shape.index(-1)] = self.shape.numel() // known.numel()
+        return SRHTStack(self.signs, self.rows, self.positions, shape)
+
+    def __getitem__(self, sketches):
+        """ the thetas of a slice of the sketches, as a SRHTStack"""
+        return SRHTStack(self.signs[sketches], self.rows[sketches],
+                         self.positions[sketches])
+
+    def to(self, *args, **kwargs):
+        """ moves the stack to a device or converts the type of the signs,
+        that is the type of the computations, as Tensor.to"""
+        signs = self.signs.to(*args, **kwargs)
+        return SRHTStack(signs, self.rows.to(signs.device),
+                         self.positions.to(signs.device), self.shape)
+
+    def inputs(self, sketch):
+        """ signs of the transforms of a sketch at the data positions,
+        scaled for the thetas to have a unit norm"""
+        return self.signs[sketch][:, self.positions[sketch]] * self.scale
+
+    def project(self, x, out=None):
+        """ projects a (N, ...) Tensor on all the thetas. returns a
+        (N, num_sketches*num_thetas) Tensor"""
+        (num_sketches, num_thetas) = self.rows.shape
+        (num_blocks, size) = self.signs.shape[1:]
+        x = x.reshape(x.shape[0], -1).to(self.signs)
+        if out is None:
+            out = x.new_empty(x.shape[0], num_sketches * num_thetas)
+        inputs = x.new_empty(x.shape[0], num_blocks, size)
+        for sketch in range(num_sketches):
+            inputs.zero_()
+            inputs.index_copy_(2, self.positions[sketch],
+                               x[:, None] * self.inputs(sketch))
+            torch.index_select(
+                hadamard(inputs).view(x.shape[0], -1), 1, self.rows[sketch],
+                out=out[:, sketch * num_thetas:(sketch + 1) * num_thetas])
+        return out
+
+    def backproject(self, grad, out=None):
+        """ brings back a (N, num_sketches*num_thetas) Tensor to the
+        flattened data space. returns a (N, dim) Tensor"""
+        (num_sketches, num_thetas) = self.rows.shape
+        (num_blocks, size) = self.signs.shape[1:]
+        grad = grad.to(self.signs)
+        if out is None:
+            out = grad.new_empty(grad.shape[0], self.dim)
+        out.zero_()
+        outputs = grad.new_empty(grad.shape[0], num_blocks * size)
+        for sketch in range(num_sketches):
+            outputs.zero_()
+            outputs.index_copy_(
+                1, self.rows[sketch],
+                grad[:, sketch * num_thetas:(sketch + 1) * num_thetas])
+            transformed = torch.index_select(
+                hadamard(outputs.view(-1, size)), 1, self.positions[sketch])
+            out += (transformed.view(grad.shape[0], num_blocks, self.dim)
+                    * self.inputs(sketch)).sum(dim=1)
+        return out
+
+
+def materialize(projector, device='cpu', dtype=torch.float32):
+    """ returns the thetas of a projector, as its (num_thetas, dim) weight,
+    or as an SRHTStack for the SRHT projectors"""
+    if isinstance(projector, SRHTProjector):
+        return projector.thetas().to(device=device, dtype=dtype)
+    return projector.weight.detach().to(device=device, dtype=dtype)
+
+
+def stack(thetas):
+    """ stacks the thetas of several projectors, given by materialize, as
+    a (num_sketches, num_thetas, dim) tensor or SRHTStack"""
+    if isinstance(thetas[0], SRHTStack):
+        return SRHTStack.cat(thetas)
+    return torch.stack(thetas)
+
+
+# id of a projector that no sketch uses, for measuring the flow on held-out
+# thetas
+HELD_OUT_ID = 2**31 - 1
+
+PROJECTORS = {'gaussian': qsketch.LinearProjector,
+              'orthonormal': OrthonormalProjector,
+              'qmc': QMCProjector,
+              'hadamard': HadamardProjector,
+              'srht': SRHTProjector}
+
+
+class ProjectorRegistry:
+    """Projection matrices of the sketches, materialized once.
+
+    Each projector of a qsketch.ModulesDataset is instantiated only once
+    from its id, and only its (num_thetas, dim) matrix is kept, or its
+    SRHTStack for SRHT projectors. The matrices
+    for a list of ids are served as one (num_sketches, num_thetas, dim)
+    tensor on the compute device, so that projecting the particles and
+    going back are batched matrix products."""
+
+    def __init__(self, modules, device='cpu', cache_size=None,
+                 dtype=torch.float32):
+        """
+        modules: qsketch.ModulesDataset
+            the projectors, that are seeded by their ids
+        device: torch.device or string
+            where to store the matrices
+        cache_size: int or None
+            maximum number of matrices to keep. The least recently used
+            ones are dropped beyond this. None means no limit.
+        dtype: torch.dtype
+            type for storing the matrices
+        """
+        self.modules = modules
+        self.device = device
+        self.cache_size = cache_size
+        self.dtype = dtype
+        self.thetas = OrderedDict()
+        self.stacked_ids = None
+        self.stacked = None
+
+    def build(self, id):
+        """ materializes the thetas of the projector `id`, without keeping
+        them. The modules are seeded by their id: the random generators are
+        restored afterwards, so that the flow doesn't depend on when the
+        projectors are built."""
+        rng = torch.get_rng_state()
+        cuda_rng = (torch.cuda.get_rng_state_all()
+                    if torch.cuda.is_available() else None)
+        thetas = materialize(self.modules[id], self.device, self.dtype)
+        torch.set_rng_state(rng)
+        if cuda_rng is not None:
+            torch.cuda.set_rng_state_all(cuda_rng)
+        return thetas
+
+    def __getitem__(self, id):
+        """ returns the (num_thetas, dim) matrix of the projector `id`"""
+        if id in self.thetas:
+            self.thetas.move_to_end(id)
+        else:
+            self.thetas[id] = self.build(id)
+            if (self.cache_size is not None
+                    and len(self.thetas) > self.cache_size):
+                self.thetas.popitem(last=False)
+        return self.thetas[id]
+
+    def stack(self, ids):
+        """ returns the (num_sketches, num_thetas, dim) tensor of the
+        matrices of the projectors with the given ids. The last stack is
+        kept, so that asking again for the same ids is free. The matrices
+        of its projectors are then kept as views of the stack, instead of
+        a second copy."""
+        ids = tuple(ids)
+        if ids != self.stacked_ids:
+            self.stacked = None
+            self.stacked = stack([self[id] for id in ids])
+            self.stacked_ids = ids
+            if torch.is_tensor(self.stacked):
+                for (id, thetas) in zip(ids, self.stacked):
+                    if id in self.thetas:
+                        self.thetas[id] = thetas
+        return self.stacked
+
+    def forward(self, particles, ids):
+        """ projects the particles on all the thetas of the given ids.
+        returns a (num_particles, num_sketches*num_thetas) tensor"""
+        thetas = self.stack(ids)
+        if isinstance(thetas, SRHTStack):
+            return thetas.project(particles)
+        return torch.mm(particles.view(particles.shape[0], -1),
+                        thetas.view(-1, thetas.shape[-1]).t())
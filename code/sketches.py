@@ -0,0 +1,376 @@
+# storage of the sketches of the data
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+
+def add_sketch_cache_arguments(parser):
+    parser.add_argument("--sketch_cache_dir",
+                        help="If provided, fixed sketches are stored in "
+                             "this directory, and reused by subsequent "
+                             "runs with the same configuration.")
+    parser.add_argument("--sketch_cache_size",
+                        help="Maximum size of the sketch cache, in MB. "
+                             "Least recently used sketches are evicted "
+                             "beyond this.",
+                        type=int,
+                        default=4096)
+    return parser
+
+
+def add_sketch_stream_arguments(parser):
+    parser.add_argument("--pipelined_sketches",
+                        help="With --no_fixed_sketch, the sketches of the "
+                             "next epoch are gathered while the current "
+                             "one is computed",
+                        action="store_true")
+    parser.add_argument("--stale_fraction",
+                        help="With --pipelined_sketches, maximum fraction "
+                             "of the sketches of an epoch that may be "
+                             "reused from the previous one when the fresh "
+                             "ones are late",
+                        type=float,
+                        default=0)
+    return parser
+
+
+def file_hash(filename):
+    """ sha1 of the content of a file, used to identify model weights and
+    data. It is stored in a .sha1 file next to it, with the size and the
+    modification time of the file, so that large files are only hashed
+    again when they change."""
+    stat = os.stat(filename)
+    stamp = ['%d' % stat.st_size, '%d' % stat.st_mtime_ns]
+    stored = filename + '.sha1'
+    try:
+        with open(stored) as f:
+            fields = f.read().split()
+        if fields[1:] == stamp:
+            return fields[0]
+    except (OSError, IndexError):
+        pass
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            sha.update(chunk)
+    try:
+        with open(stored, 'w') as f:
+            f.write(' '.join([sha.hexdigest()] + stamp) + '\n')
+    except OSError:
+        # the directory may be read only: the file is hashed each time
+        pass
+    return sha.hexdigest()
+
+
+class SketchCache:
+    """Content-addressed on-disk store for fixed sketches.
+
+    Each entry is a directory named after the hash of the parameters that
+    produced the sketches. It contains the target quantiles as a
+    (num_sketches, num_thetas, num_quantiles) array, that is memory-mapped
+    when loaded, as well as the ids of the corresponding projectors.
+    The total size of the cache is bounded, and the least recently used
+    entries are evicted first."""
+
+    def __init__(self, cache_dir, max_size=None):
+        """
+        cache_dir: string
+            directory where to store the sketches
+        max_size: int or None
+            maximum size of the cache in bytes. None means no limit.
+        """
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.max_size = max_size
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    @staticmethod
+    def key(**params):
+        """ computes the key corresponding to some sketching parameters.
+        These must be json serializable."""
+        params = json.dumps(params, sort_keys=True, default=str)
+        return hashlib.sha1(params.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def load(self, key):
+        """returns (target_qf, ids) for the given key, or None if it is not
+        in the cache. target_qf is memory-mapped."""
+        path = self.path(key)
+        if not os.path.exists(os.path.join(path, 'ids.npy')):
+            return None
+        target_qf = torch.from_numpy(
+            np.load(os.path.join(path, 'target_qf.npy'), mmap_mode='c'))
+        ids = np.load(os.path.join(path, 'ids.npy')).tolist()
+
+        # mark the entry as recently used
+        os.utime(path, None)
+        return (target_qf, ids)
+
+    def save(self, key, target_qf, ids, **params):
+        """stores the target quantiles and projectors ids under the given
+        key. Additional parameters are written along for reference."""
+        path = self.path(key)
+        # write everything to a temporary directory first, so that an
+        # interrupted write never leaves an incomplete entry
+        tmp_path = tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp')
+        np.save(os.path.join(tmp_path, 'target_qf.npy'),
+                target_qf.detach().cpu().contiguous().numpy())
+        with open(os.path.join(tmp_path, 'params.json'), 'w') as f:
+            json.dump(params, f, sort_keys=True, default=str)
+        # the ids are written last, and mark the entry as complete
+        np.save(os.path.join(tmp_path, 'ids.npy'), np.array(ids))
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+        self.evict(keep=key)
+
+    def entries(self):
+        """ returns the list of (key, size, last_access) of the cache"""
+        res = []
+        for key in os.listdir(self.cache_dir):
+            path = self.path(key)
+            if key.startswith('.') or not os.path.isdir(path):
+                continue
+            size = sum(os.path.getsize(os.path.join(path, f))
+                       for f in os.listdir(path))
+            res += [(key, size, os.path.getmtime(path))]
+        return res
+
+    def evict(self, keep=None):
+        """removes the least recently used entries until the size of the
+        cache is below max_size. The entry `keep` is never removed."""
+        if self.max_size is None:
+            return
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        total = sum(entry[1] for entry in entries)
+        for (key, size, _) in entries:
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self.path(key))
+            total -= size
+
+
+class SketchBank:
+    """In-memory bank of sketches.
+
+    Holds the target quantiles of several sketches as one preallocated
+    contiguous (num_sketches, num_thetas, num_quantiles) tensor on the
+    compute device, along with the ids of the corresponding projectors.
+    Once filled, replaying the sketches is a plain indexing, with no copy."""
+
+    def __init__(self, num_sketches, device='cpu'):
+        """
+        num_sketches: int
+            maximum number of sketches in the bank
+        device: torch.device or string
+            where to store the target quantiles
+        """
+        self.num_sketches = num_sketches
+        self.device = device
+        self.data = None
+        self.ids = []
+
+    @classmethod
+    def from_sketches(cls, target_qf, ids, device='cpu'):
+        """ creates a bank from already stacked target quantiles, of shape
+        (num_sketches, num_thetas, num_quantiles)"""
+        bank = cls(len(ids), device)
+        bank.data = target_qf.to(device).contiguous()
+        bank.ids = list(ids)
+        return bank
+
+    def add(self, target_qf, id):
+        """ adds a sketch to the bank. target_qf has shape
+        (num_quantiles, num_thetas), as produced by the sketcher."""
+        if len(self.ids) == self.num_sketches:
+            raise IndexError('The sketch bank is full')
+        if self.data is None:
+            # allocate the whole bank with the first sketch
+            self.data = torch.empty(self.num_sketches, *target_qf.t().shape,
+                                    dtype=target_qf.dtype,
+                                    device=self.device)
+        self.data[len(self.ids)].copy_(target_qf.t())
+        self.ids += [id]
+
+    @property
+    def target_qf(self):
+        """ the target quantiles of all the sketches in the bank"""
+        return self.data[:len(self.ids)]
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class SketchPrefetcher:
+    """Double-buffered reader of a sketch queue.
+
+    A thread gathers the sketches of the next epoch in a bank, while the
+    flow uses the bank of the current epoch. When the flow asks for the
+    next bank, it only waits for the fresh sketches that are still missing.
+    If a `stale_fraction` is given, up to that fraction of the bank may be
+    completed with sketches of the previous epoch instead of waiting, and
+    the fresh sketches that arrive later go to the following epoch.
+
+    The time spent waiting on the queue by the thread, minus the time the
+    flow spent waiting for the banks, is the waiting time that was hidden
+    behind the computations."""
+
+    def __init__(self, sketch_queue, num_sketches, num_epochs, device='cpu',
+                 stale_fraction=0):
+        """
+        sketch_queue: queue
+            the queue of the sketcher, giving (target_qf, id) items and a
+            None sentinel after the sketches of each epoch
+        num_sketches: int
+            number of sketches per epoch
+        num_epochs: int
+            number of epochs streamed by the sketcher
+        device: torch.device or string
+            where to store the target quantiles
+        stale_fraction: float
+            maximum fraction of stale sketches in a bank
+        """
+        self.queue = sketch_queue
+        self.num_sketches = num_sketches
+        self.num_epochs = num_epochs
+        self.min_fresh = max(1, num_sketches - int(stale_fraction
+                                                   * num_sketches))
+        self.banks = [SketchBank(num_sketches, device),
+                      SketchBank(num_sketches, device)]
+        self.filling = 0
+        # number of fresh sketches of each bank, that come before the stale
+        # ones, so that stale sketches are only taken from fresh ones
+        self.fresh = [0, 0]
+        self.finished = False
+        self.queue_wait = 0.
+        self.flow_wait = 0.
+        self.stale = 0
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.gather, daemon=True)
+        self.thread.start()
+
+    def gather(self):
+        ended = 0
+        while ended < self.num_epochs:
+            start = time.perf_counter()
+            item = self.queue.get()
+            waited = time.perf_counter() - start
+            with self.condition:
+                self.queue_wait += waited
+                if item is None:
+                    ended += 1
+                    continue
+                # wait for the flow to release a bank if this one is full
+                self.condition.wait_for(
+                    lambda: len(self.banks[self.filling]) < self.num_sketches)
+                self.banks[self.filling].add(*item)
+                self.condition.notify_all()
+        with self.condition:
+            self.finished = True
+            self.condition.notify_all()
+
+    def next(self):
+        """ returns the bank for the next epoch, completed with stale
+        sketches if needed and allowed"""
+        start = time.perf_counter()
+        with self.condition:
+            bank = self.banks[self.filling]
+            previous = self.banks[1 - self.filling]
+            needed = (self.min_fresh if self.fresh[1 - self.filling]
+                      else self.num_sketches)
+            self.condition.wait_for(
+                lambda: len(bank) >= needed or self.finished)
+            self.flow_wait += time.perf_counter() - start
+
+            # complete with the most recent fresh sketches of the previous
+            # epoch, and not with its own stale ones, that would otherwise
+            # be reused epoch after epoch
+            fresh = self.fresh[1 - self.filling]
+            self.fresh[self.filling] = len(bank)
+            missing = min(self.num_sketches - len(bank), fresh)
+            for index in range(fresh - missing, fresh):
+                bank.add(previous.data[index].t(), previous.ids[index])
+            self.stale += missing
+
+            # the previous bank is now free for the next fresh sketches
+            previous.ids = []
+            self.filling = 1 - self.filling
+            self.condition.notify_all()
+        return bank
+
+    @property
+    def hidden_wait(self):
+        """ time spent waiting on the queue that the flow didn't see"""
+        return max(0., self.queue_wait - self.flow_wait)
+
+
+class SketchRing:
+    """Ring of preallocated shared-memory slots carrying sketches from the
+    sketchers to the flow.
+
+    A sketcher takes a free slot, writes the quantiles of a sketch in
+    place, and publishes the slot index together with the sketch id. Only
+    these two integers go through a queue, so that the quantiles are never
+    serialized. On the flow side, the ring is read like the queue of a
+    sketcher: `get()` returns (target_qf, id) items, with a None after
+    each `sketches_per_epoch` of them. The returned target_qf is a view of
+    the slot, that is released at the next call to `get()`, so it must be
+    copied before."""
+
+    def __init__(self, num_slots, shape, sketches_per_epoch,
+                 dtype=torch.float32):
+        """
+        num_slots: int
+            number of slots. This bounds the number of sketches waiting
+            for the flow.
+        shape: tuple
+            shape of the quantiles of a sketch, (num_quantiles, num_thetas)
+        sketches_per_epoch: int
+            number of sketches before each None
+        dtype: torch.dtype
+            type of the quantiles
+        """
+        self.slots = torch.zeros(num_slots, *shape,
+                                 dtype=dtype).share_memory_()
+        self.free = mp.Queue()
+        for slot in range(num_slots):
+            self.free.put(slot)
+        self.ready = mp.Queue()
+        self.sketches_per_epoch = sketches_per_epoch
+        self.delivered = 0
+        self.current = None
+
+    def acquire(self):
+        """ sketcher side: waits for a free slot, and returns its index and
+        the tensor to write the quantiles into"""
+        slot = self.free.get()
+        return (slot, self.slots[slot])
+
+    def publish(self, slot, id):
+        """ sketcher side: hands a written slot over to the flow"""
+        self.ready.put((slot, id))
+
+    def get(self):
+        """ flow side: returns the next (target_qf, id), or None at the end
+        of an epoch. The slot of the previous item is released."""
+        if self.current is not None:
+            self.free.put(self.current)
+            self.current = None
+        if self.delivered == self.sketches_per_epoch:
+            self.delivered = 0
+            return None
+        (slot, id) = self.ready.get()
+        self.current = slot
+        self.delivered += 1
+        return (self.slots[slot], id)
@@ -0,0 +1,163 @@
+# computation of the sketches of the data, in worker processes
+import torch
+import torch.multiprocessing as mp
+import data
+import engine
+import projection
+import sketches
+
+
+def add_sketching_arguments(parser):
+    parser.add_argument("--shared_sketches",
+                        help="If active, the sketches are computed by "
+                             "workers reading the dataset directly, and "
+                             "given to the flow through shared memory "
+                             "instead of queues",
+                        action="store_true")
+    parser.add_argument("--sketch_slots",
+                        help="With --shared_sketches, number of sketches "
+                             "that may wait for the flow. Defaults to two "
+                             "per sketcher.",
+                        type=int)
+    parser.add_argument("--sketch_batch_size",
+                        help="With --shared_sketches, number of items "
+                             "projected at once. Each sketch is built in a "
+                             "streaming pass over batches of this size, so "
+                             "that --num_examples may be as large as the "
+                             "dataset. A non positive --num_examples means "
+                             "the whole dataset.",
+                        type=int,
+                        default=5000)
+    parser.add_argument("--sketch_group",
+                        help="With --shared_sketches, number of sketches "
+                             "computed together on the same examples, "
+                             "with one product per batch of data",
+                        type=int,
+                        default=1)
+    return parser
+
+
+def sketch_batches(dataset, num_examples, batch_size, seed):
+    """yields the examples of a sketch by batches: num_examples random
+    items drawn with the given seed, or the whole dataset in order if
+    num_examples is not positive."""
+    if num_examples is None or num_examples <= 0:
+        for start in range(0, len(dataset), batch_size):
+            yield data.get_batch(dataset, slice(start, start + batch_size))
+        return
+    generator = torch.Generator().manual_seed(seed)
+    indices = torch.randint(len(dataset), (num_examples,),
+                            generator=generator)
+    for batch in indices.split(batch_size):
+        yield data.get_batch(dataset, batch)
+
+
+def sketch_worker(dataset, modules, percentiles, levels, num_examples,
+                  batch_size, ring, tasks, num_threads):
+    """Process computing sketches. It gets lists of ids from `tasks`. The
+    sketches of a list are computed together, in a streaming pass over
+    the same examples: each batch is projected on the thetas of all of them
+    at once, and summarized by its quantiles at `levels`. The quantiles of
+    each sketch are then written to a slot of the ring."""
+    torch.set_num_threads(num_threads)
+    for ids in iter(tasks.get, None):
+        with torch.no_grad():
+            thetas = [projection.materialize(modules[id]) for id in ids]
+            stacked = projection.stack(thetas)
+            summary = engine.StreamingQuantiles(
+                stacked.view(-1, stacked.shape[-1]), levels)
+            # the examples only depend on the first id of the list
+            for batch in sketch_batches(dataset, num_examples, batch_size,
+                                        ids[0]):
+                summary.update(batch.float())
+            target_qf = summary.quantiles(percentiles)
+        start = 0
+        for (id, theta) in zip(ids, thetas):
+            (slot, buffer) = ring.acquire()
+            buffer.copy_(target_qf[:, start:start + theta.shape[0]])
+            ring.publish(slot, id)
+            start += theta.shape[0]
+
+
+class SharedSketcher:
+    """Sketcher whose workers read the dataset directly and give their
+    sketches through a sketches.SketchRing.
+
+    Each sketch is computed in a single streaming pass over its examples,
+    by batches, with engine.StreamingQuantiles summaries of bounded size.
+    Several sketches may be computed together, with one product per batch.
+
+    It is used like a qsketch.Sketcher: after `stream()`, the sketches are
+    read from `queue`, with a None after the sketches of each epoch."""
+
+    def __init__(self, dataset, percentiles, num_examples, num_thetas,
+                 num_slots=None, batch_size=5000, group=1,
+                 num_summary_quantiles=None):
+        """
+        dataset: dataset
+            the data to sketch. Datasets with a get_batch method are read
+            by batches.
+        percentiles: Tensor (num_quantiles,)
+            the percentiles of the sketches
+        num_examples: int
+            number of items drawn from the dataset for each sketch. If not
+            positive, the whole dataset is used.
+        num_thetas: int
+            number of projections of each sketch
+        num_slots: int or None
+            number of slots of the ring. Defaults to two per worker.
+        batch_size: int
+            number of items projected at once
+        group: int
+            number of sketches computed together on the same examples
+        num_summary_quantiles: int or None
+            number of levels of the streaming summaries, in addition to the
+            percentiles. Defaults to four times the number of percentiles.
+        """
+        self.dataset = dataset
+        self.percentiles = percentiles
+        self.num_examples = num_examples
+        self.num_thetas = num_thetas
+        self.num_slots = num_slots
+        self.batch_size = batch_size
+        self.group = group
+        if num_summary_quantiles is None:
+            num_summary_quantiles = 4 * len(percentiles)
+        # the summaries are exact at the percentiles when a sketch fits in
+        # a single batch
+        self.levels = torch.unique(torch.cat(
+            (torch.linspace(0, 100, num_summary_quantiles),
+             percentiles.float())))
+        self.shared_data = {}
+        self.queue = None
+        self.tasks = None
+        self.workers = []
+
+    def stream(self, modules, num_sketches, num_epochs, num_workers=2,
+               first_id=0):
+        """starts the workers computing num_sketches sketches for each of
+        the num_epochs epochs. With a single epoch, the sketches have ids
+        first_id, ..., first_id + num_sketches - 1, and new ids are used for
+        each additional epoch."""
+        self.shared_data['num_sketches'] = num_sketches
+        self.shared_data['num_epochs'] = num_epochs
+        num_slots = self.num_slots or 2 * num_workers
+        self.queue = sketches.SketchRing(
+            num_slots, (len(self.percentiles), self.num_thetas),
+            num_sketches)
+        self.tasks = mp.Queue()
+        ids = list(range(first_id, first_id + num_sketches * num_epochs))
+        for start in range(0, len(ids), self.group):
+            self.tasks.put(ids[start:start + self.group])
+        num_threads = max(1, torch.get_num_threads() // num_workers)
+        self.workers = [
+            mp.Process(target=sketch_worker,
+                       args=(self.dataset, modules, self.percentiles,
+                             self.levels, self.num_examples,
+                             self.batch_size, self.queue, self.tasks,
+                             num_threads),
+                       daemon=True)
+            for _ in range(num_workers)]
+        for worker in self.workers:
+            self.tasks.put(None)
+            worker.start()
@@ -1,127 +1,223 @@
 # imports
 import os
 import torch
-from torch import nn
 import qsketch
 import data
 import argparse
 import plotting
 import torch.multiprocessing as mp
 import networks
-from torchinterp1d import Interp1d
-from torchpercentile import Percentile
+import engine
+import sketches
+import sketching
+import projection
+import parallel
+import checkpoint
+import profiling
+import integrator as integration
 from math import sqrt
 from tqdm import tqdm, trange
 import copy
 
 
-def swf(train_particles, test_particles, sketcher, projector_modules,
+def swf(train_particles, test_particles, sketcher, projectors,
         stepsize, regularization, num_epochs,
-        device_str, plot_function):
+        device_str, plot_function, fixed_sketches=None,
+        num_flow_workers=1, dtype=torch.float32, chunk_size=None,
+        start_epoch=0, checkpoint_function=None,
+        profiler=profiling.NULL_PROFILER, integrator=None,
+        early_stopping=None, test_loss_schedule=None,
+        pipelined_sketches=False, stale_fraction=0):
     """Starts a Sliced Wasserstein Flow with the train_particles, to match
     the distribution whose sketches are given by the target queue.
 
     The function gets sketches from the queue, and then applies steps of a
     SWF to the particles. The flow is parameterized by a stepsize and a
-    regularization parameter. """
+    regularization parameter. The projectors are given as a
+    projection.ProjectorRegistry.
+
+    If `fixed_sketches` is provided, it must be a sketches.SketchBank
+    holding the sketches to use at every epoch instead of the queue.
+
+    If `num_flow_workers` is more than 1, the train particles are split
+    across as many processes, that transport them in parallel.
+
+    The particles and their projections are stored with the given `dtype`,
+    which may be float16 or bfloat16 to save memory. The thetas of the
+    projectors should then have the same type. Quantiles and steps are
+    always computed in float32.
+
+    If `chunk_size` is given, the particles of each process are transported
+    by chunks of that size, to bound the memory used.
+
+    The flow starts at `start_epoch`, to resume a previous run. If given,
+    `checkpoint_function` is called with the local variables after each
+    epoch, like `plot_function`.
+
+    The stages of each epoch are timed by the `profiler`, which is a
+    profiling.Profiler. By default, nothing is timed.
+
+    The steps are applied by `integrator`, an integrator.Integrator that may
+    add momentum or adapt the stepsize. By default, constant steps of size
+    `stepsize` are made. If `early_stopping` is given, as an
+    integrator.EarlyStopping, the flow stops before `num_epochs` once the
+    train loss doesn't improve anymore.
+
+    The test particles are only pushed forward with the quantiles of the
+    train ones. Their own quantiles are just needed for their loss, which
+    is computed at the epochs for which `test_loss_schedule(epoch)` is True.
+    By default, this is done at every epoch.
+
+    If `pipelined_sketches` is True and new sketches come at each epoch,
+    those of the next epoch are gathered while the current one is computed.
+    When they are late, up to `stale_fraction` of them may be replaced by
+    sketches of the previous epoch. """
 
     # get the device
     device = torch.device(device_str)
 
-    # pre-allocate variables
+    # pre-allocate variables. If the train and test particles are both
+    # handled here, they are views of a single tensor, so that they are
+    # projected together
     particles = {}
-    particles['train'] = train_particles.to(device)
-    if test_particles is not None:
-        particles['test'] = test_particles.to(device)
+    joint = (test_particles is not None and num_flow_workers <= 1
+             and chunk_size is None)
+    if joint:
+        num_train = train_particles.shape[0]
+        all_particles = torch.cat(
+            (train_particles.to(device=device, dtype=dtype),
+             test_particles.to(device=device, dtype=dtype)))
+        particles['train'] = all_particles[:num_train]
+        particles['test'] = all_particles[num_train:]
+    else:
+        particles['train'] = train_particles.to(device=device, dtype=dtype)
+        if test_particles is not None:
+            particles['test'] = test_particles.to(device=device,
+                                                  dtype=dtype)
 
     step = {}
     step_weight = {}
-    interp_q = {}
-    transported = {}
     particles_qf = {}
-    projections = {}
     loss = {}
-    for task in particles:
-        interp_q[task] = None
-        transported[task] = None
-
-    data_shape = train_particles[0].shape
-    criterion = nn.MSELoss()
     data_queue = sketcher.queue
-    percentiles = sketcher.percentiles.clone().to(device)
-    bar_epoch = trange(num_epochs, desc="epoch")
+    percentiles = sketcher.percentiles.clone().to(device=device,
+                                                  dtype=torch.float32)
+    slice_step = {}
+    for task in particles:
+        slice_step[task] = engine.SliceStep(percentiles, dtype=dtype,
+                                            chunk_size=chunk_size,
+                                            profiler=profiler)
+
+    if integrator is None:
+        integrator = integration.Integrator(stepsize)
+
+    # the train particles may be handled by several processes
+    sharded_flow = None
+    local_tasks = list(particles.keys())
+    if num_flow_workers > 1:
+        if not integrator.plain:
+            raise ValueError('Sharded flows only support constant steps '
+                             'without momentum')
+        sharded_flow = parallel.ShardedFlow(particles['train'], percentiles,
+                                            num_flow_workers,
+                                            chunk_size=chunk_size)
+        local_tasks.remove('train')
+    bar_epoch = trange(start_epoch, num_epochs, desc="epoch")
+
+    # if the sketches are given, the projectors are built once for all
+    sketch_bank = fixed_sketches
+    if sketch_bank is not None:
+        target_qf = sketch_bank.target_qf
+        thetas = projectors.stack(sketch_bank.ids)
+
+    # new sketches at each epoch may be gathered in the background
+    prefetcher = None
+    if (sketch_bank is None and pipelined_sketches
+            and sketcher.shared_data['num_epochs'] > 1):
+        prefetcher = sketches.SketchPrefetcher(
+            data_queue, sketcher.shared_data['num_sketches'],
+            sketcher.shared_data['num_epochs'], device=device,
+            stale_fraction=stale_fraction)
 
     # call the plot function before starting
     if plot_function is not None:
-        plot_function(locals(), 0)
+        plot_function(locals(), start_epoch)
 
     # loop over epochs
     for epoch in bar_epoch:
-        if sketcher.shared_data['num_epochs'] == 1:
-            next_queue = mp.Queue()
-
-        # reset the step for both train and test
-        for task in particles:
-            step[task] = 0
-            step_weight[task] = 0
-            loss[task] = 0
-
-        pbar = tqdm(total=sketcher.shared_data['num_sketches'])
-        # get the data from the sketching queue until the None sentinel
-        for (target_qf, id) in iter(data_queue.get, None):
-            # print('SWF, got id %d', id)
-            # putting back the data to our temporary queue
+        if prefetcher is not None:
+            # the sketches were gathered during the previous epoch
+            stale = prefetcher.stale
+            with profiler.section('queue_wait'):
+                bank = prefetcher.next()
+            profiler.count('sketches', len(bank))
+            profiler.count('stale_sketches', prefetcher.stale - stale)
+            target_qf = bank.target_qf
+            thetas = projectors.stack(bank.ids)
+        elif sketch_bank is None:
+            # get the data from the sketching queue until the None sentinel
+            pbar = tqdm(total=sketcher.shared_data['num_sketches'])
+            bank = sketches.SketchBank(sketcher.shared_data['num_sketches'],
+                                       device=device)
+            with profiler.section('queue_wait'):
+                for (sketch_qf, id) in iter(data_queue.get, None):
+                    bank.add(sketch_qf, id)
+                    pbar.update(1)
+            profiler.count('sketches', len(bank))
+
+            # stack all the projectors of the epoch together
+            target_qf = bank.target_qf
+            thetas = projectors.stack(bank.ids)
+
+            # if we are reusing the same sketches again, we keep them
             if sketcher.shared_data['num_epochs'] == 1:
-                next_queue.put((target_qf.detach().clone(), id))
-
-            # putting the target quantiles to device and setting the projector
-            target_qf = target_qf.to(device)
-            projector = projector_modules[id]
-            for task in particles:  # will include test if provided
-                with torch.no_grad():
-                    num_particles = particles[task].shape[0]
-                    # project the particles
-                    projections[task] = projector(particles[task])
-
-                    # compute the corresponding quantiles
-                    particles_qf[task] = Percentile()(projections[task],
-                                                      percentiles)
-
-                    # compute the loss: squared error over the quantiles
-                    loss[task] += criterion(particles_qf[task], target_qf)
-
-                    # transort the marginals, using only the quantiles of train
-                    interp_q[task] = Interp1d()(x=particles_qf['train'].t(),
-                                                y=percentiles,
-                                                xnew=projections[task].t(),
-                                                out=interp_q[task])
-                    transported[task] = Interp1d()(x=percentiles,
-                                                   y=target_qf.t(),
-                                                   xnew=interp_q[task],
-                                                   out=transported[task])
-
-                    step_weight[task] += projections[task].shape[1]
-                    step[task] += (
-                        projector.backward(
-                                transported[task].t() - projections[task])
-                        .view(num_particles, *data_shape))
-            pbar.update(1)
+                sketch_bank = bank
+
+        # compute the steps for all the sketches in one pass. Transport
+        # always uses the quantiles of train.
+        if sharded_flow is not None:
+            with profiler.section('sharded_step'):
+                (particles_qf['train'], loss['train']) = sharded_flow.step(
+                    thetas, target_qf, integrator.stepsize,
+                    regularization)
+        with_test_loss = (test_loss_schedule is None
+                          or test_loss_schedule(epoch + 1))
+        with torch.no_grad():
+            if joint:
+                (displacement, particles_qf['train'], loss['train'],
+                    loss['test']) = slice_step['train'].joint(
+                        all_particles, num_train, thetas, target_qf,
+                        with_test_loss)
+                step['train'] = displacement[:num_train]
+                step['test'] = displacement[num_train:]
+            else:
+                for task in local_tasks:  # will include test if provided
+                    (step[task], particles_qf[task], loss[task]) = (
+                        slice_step[task](
+                            particles[task], thetas, target_qf,
+                            reference_qf=(None if task == 'train'
+                                          else particles_qf['train']),
+                            with_loss=task == 'train' or with_test_loss))
+        for task in local_tasks:
+            step_weight[task] = thetas.shape[0] * thetas.shape[1]
+        if loss.get('test') is None:
+            # the test loss was not computed at this epoch
+            loss.pop('test', None)
 
         # we got all the updates with the sketches. Now apply the steps
-        for task in particles:
-            # first apply the step
-            particles[task] += stepsize/step_weight[task]*step[task]
-
-            # then possibly add the noise if needed
-            noise = torch.randn(*particles[task].shape, device=device)
-            noise /= sqrt(particles[task].shape[-1])
-            particles[task] += regularization * noise
-
-        # if we are reusing the same sketches again, we prepare the sentinel
-        # and replace the data source by what we just recorded
-        if sketcher.shared_data['num_epochs'] == 1:
-            next_queue.put(None)
-            data_queue = next_queue
+        with profiler.section('update'):
+            if 'train' in local_tasks:
+                integrator.adapt(step['train'] / step_weight['train'])
+            for task in local_tasks:
+                # first apply the step
+                integrator(task, particles[task], step[task],
+                           step_weight[task])
+
+                # then possibly add the noise if needed
+                noise = torch.randn(*particles[task].shape, device=device)
+                noise /= sqrt(particles[task].shape[-1])
+                particles[task] += regularization * noise
+        profiler.count('projections', thetas.shape[0] * thetas.shape[1])
 
         # Now do some logging / plotting
         loss_str = 'epoch %d: ' % (epoch + 1)
@@ -130,8 +226,28 @@ def swf(train_particles, test_particles, sketcher, projector_modules,
         bar_epoch.write(loss_str)
 
         if plot_function is not None:
-            plot_function(locals(), epoch+1)
-
+            with profiler.section('plot'):
+                plot_function(locals(), epoch+1)
+
+        if checkpoint_function is not None:
+            with profiler.section('checkpoint'):
+                checkpoint_function(locals(), epoch+1)
+        profiler.epoch(epoch+1)
+
+        if early_stopping is not None and early_stopping(loss['train']):
+            bar_epoch.write('stopping at epoch %d: the train loss is not '
+                            'improving anymore' % (epoch + 1))
+            if checkpoint_function is not None:
+                checkpoint_function(locals(), epoch+1, force=True)
+            break
+
+    if prefetcher is not None:
+        bar_epoch.write('sketches: waited %0.2fs, %0.2fs of waiting hidden, '
+                        '%d stale sketches used'
+                        % (prefetcher.flow_wait, prefetcher.hidden_wait,
+                           prefetcher.stale))
+    if sharded_flow is not None:
+        sharded_flow.close()
     return (
         (particles['train'], particles['test']) if 'test' in particles
         else particles['train'])
@@ -145,6 +261,13 @@ if __name__ == "__main__":
     parser = qsketch.add_sketch_arguments(parser)
     parser = data.add_data_arguments(parser)
     parser = plotting.add_plotting_arguments(parser)
+    parser = sketches.add_sketch_cache_arguments(parser)
+    parser = sketches.add_sketch_stream_arguments(parser)
+    parser = sketching.add_sketching_arguments(parser)
+    parser = projection.add_projection_arguments(parser)
+    parser = checkpoint.add_checkpoint_arguments(parser)
+    parser = profiling.add_profiling_arguments(parser)
+    parser = integration.add_integrator_arguments(parser)
 
     parser.add_argument("--input_dim",
                         help="Dimension of the random input to the "
@@ -200,6 +323,23 @@ if __name__ == "__main__":
     parser.add_argument("--test_type",
                         help="different kinds of test options. should be "
                              "either RANDOM or INTERPOLATE.")
+    parser.add_argument("--num_flow_workers",
+                        help="number of processes sharing the train "
+                             "particles for the flow. Only on cpu.",
+                        type=int,
+                        default=1)
+    parser.add_argument("--chunk_size",
+                        help="If provided, particles are transported by "
+                             "chunks of this size, to bound memory usage.",
+                        type=int)
+    parser.add_argument("--precision",
+                        help="storage type for the particles, the "
+                             "thetas and the projections, that are "
+                             "computed with products of matrices of this "
+                             "type. Quantiles and steps are always "
+                             "computed in float32.",
+                        choices=['float32', 'float16', 'bfloat16'],
+                        default='float32')
     parser.add_argument("--num_dataworkers",
                         help="number of workers for the datastream",
                         type=int,
@@ -215,7 +355,8 @@ if __name__ == "__main__":
     train_data = data.load_image_dataset(
         dataset=args.dataset,
         data_dir=args.root_data_dir,
-        img_size=args.img_size
+        img_size=args.img_size,
+        image_store=not args.no_image_store
     )
 
     # prepare AE
@@ -254,43 +395,135 @@ if __name__ == "__main__":
             autoencoder.model.to('cpu').load_state_dict(state)
             print("Model loaded")
 
-        # augmenting the dataset with calling the encoder, to get an item
+        # encoding the whole dataset once. If the AE weights are saved, the
+        # codes are stored along them, and reused by subsequent runs.
         # make sure that the encoder doesn't require grad
         for p in autoencoder.model.parameters():
             p.requires_grad = False
         autoencoder.model = autoencoder.model.to(device)
-        train_data = qsketch.TransformedDataset(
+        ae_hash = (sketches.file_hash(ae_filename)
+                   if os.path.exists(ae_filename) else None)
+        features_filename = (
+            None if ae_hash is None
+            else os.path.join('weights', 'features_%s_%s.npy'
+                              % (os.path.basename(ae_filename), ae_hash[:16])))
+        print('encoding the dataset', '' if features_filename is None
+              else 'to %s' % features_filename)
+        train_data = data.encode_dataset(
             train_data,
-            transform=autoencoder.model.encode,
+            encode=autoencoder.model.encode,
+            filename=features_filename,
             device=device)
 
-    # Launch the data stream
-    data_stream = qsketch.DataStream(train_data,
-                                     num_workers=args.num_dataworkers)
-    data_stream.stream()
-
     data_shape = train_data[0][0].shape
 
     # prepare the sketcher
-    sketcher = qsketch.Sketcher(data_source=data_stream,
-                                percentiles=torch.linspace(
-                                        0, 100, args.num_quantiles),
-                                num_examples=args.num_examples,
-                                )
+    if args.shared_sketches:
+        # the sketchers read the dataset themselves
+        sketcher = sketching.SharedSketcher(
+            train_data,
+            percentiles=torch.linspace(0, 100, args.num_quantiles),
+            num_examples=args.num_examples,
+            num_thetas=args.num_thetas,
+            num_slots=args.sketch_slots,
+            batch_size=args.sketch_batch_size,
+            group=args.sketch_group)
+    else:
+        # the data stream is only launched if the sketches are computed
+        data_stream = qsketch.DataStream(train_data,
+                                         num_workers=args.num_dataworkers)
+
+        sketcher = qsketch.Sketcher(data_source=data_stream,
+                                    percentiles=torch.linspace(
+                                            0, 100, args.num_quantiles),
+                                    num_examples=args.num_examples,
+                                    )
+
+    # parameters identifying the data the flow works on. The toy data may be
+    # generated again with other parameters: their content is hashed
+    data_params = dict(
+        dataset=os.path.basename(os.path.normpath(args.dataset)),
+        img_size=args.img_size,
+        ae=ae_hash if args.ae else None,
+        data=(sketches.file_hash(data.TOY_FILENAME)
+              if args.dataset.upper() == 'TOY' else None))
 
     # prepare the projectors
-    projectors = qsketch.ModulesDataset(
-                        qsketch.LinearProjector,
+    projector_class = projection.PROJECTORS[
+        'orthonormal' if args.orthonormal_thetas else args.projector]
+    projector_modules = qsketch.ModulesDataset(
+                        projector_class,
                         device=device_str,
                         input_shape=data_shape,
                         num_projections=args.num_thetas)
 
-    sketcher.stream(modules=projectors,
-                    num_sketches=args.num_sketches,
-                    num_epochs=(
-                            args.num_epochs if args.no_fixed_sketch
-                            else 1),
-                    num_workers=args.num_sketchers)
+    # possibly resume from a checkpoint, that holds the fixed sketches
+    state = None
+    start_epoch = 0
+    fixed_sketches = None
+    if args.resume and args.checkpoint is not None:
+        state = checkpoint.load(os.path.expanduser(args.checkpoint))
+    if state is not None:
+        print('Resuming from epoch', state['epoch'])
+        start_epoch = state['epoch']
+        if state['sketches'] is not None:
+            fixed_sketches = sketches.SketchBank.from_sketches(
+                *state['sketches'], device=device)
+
+    # look for the fixed sketches in the cache
+    if (fixed_sketches is None and args.sketch_cache_dir is not None
+            and not args.no_fixed_sketch):
+        sketch_cache = sketches.SketchCache(
+            args.sketch_cache_dir,
+            max_size=args.sketch_cache_size * 2**20)
+        sketch_params = dict(
+            data_params,
+            data_shape=list(data_shape),
+            projector=projector_class.__name__,
+            num_thetas=args.num_thetas,
+            num_sketches=args.num_sketches,
+            num_quantiles=args.num_quantiles,
+            # the shared sketchers use the whole dataset for a non positive
+            # number of examples, and draw the examples of a group of
+            # sketches together, by batches
+            num_examples=(None if args.shared_sketches
+                          and (args.num_examples is None
+                               or args.num_examples <= 0)
+                          else args.num_examples),
+            shared_sketches=args.shared_sketches,
+            sketch_group=(args.sketch_group if args.shared_sketches
+                          else None),
+            sketch_batch_size=(args.sketch_batch_size
+                               if args.shared_sketches else None))
+        sketch_key = sketch_cache.key(**sketch_params)
+        cached = sketch_cache.load(sketch_key)
+        if cached is not None:
+            print('Using cached sketches', sketch_key)
+            fixed_sketches = sketches.SketchBank.from_sketches(
+                *cached, device=device)
+
+    if fixed_sketches is None:
+        if not args.shared_sketches:
+            data_stream.stream()
+        sketcher.stream(modules=projector_modules,
+                        num_sketches=args.num_sketches,
+                        num_epochs=(
+                                args.num_epochs - start_epoch
+                                if args.no_fixed_sketch
+                                else 1),
+                        num_workers=args.num_sketchers)
+
+    if fixed_sketches is None and args.sketch_cache_dir is not None \
+            and not args.no_fixed_sketch:
+        # get all the fixed sketches to store them in the cache
+        fixed_sketches = sketches.SketchBank(args.num_sketches,
+                                             device=device)
+        for (sketch_qf, id) in tqdm(iter(sketcher.queue.get, None),
+                                    total=args.num_sketches,
+                                    desc='sketching'):
+            fixed_sketches.add(sketch_qf, id)
+        sketch_cache.save(sketch_key, fixed_sketches.target_qf,
+                          fixed_sketches.ids, **sketch_params)
 
     # generates the train particles
     print('using ', device)
@@ -346,37 +579,109 @@ if __name__ == "__main__":
     if test_particles is not None:
         test_particles = test_particles.view(-1, *data_shape)
 
-    plotter = plotting.SWFPlot(features=min(train_particles.shape[-1],
-                                            args.plot_num_features),
-                               dataset=train_data,
-                               plot_dir=args.plot_dir,
-                               no_density_plot=args.no_density_plot,
-                               no_particles_plot=args.no_particles_plot,
-                               no_closest_plot=args.no_closest_plot,
-                               no_swcost_plot=args.no_swcost_plot,
-                               plot_every=args.plot_every,
-                               plot_epochs=args.plot_epochs,
-                               match_every=args.match_every,
-                               plot_num_train=args.plot_num_train,
-                               plot_num_test=args.plot_num_test,
-                               decode_fn=(
-                                copy.deepcopy(autoencoder.model).to('cpu').decode_nograd if args.ae
-                                else None),
-                               make_titles=False,
-                               dpi=300,
-                               basefilename=args.basefilename,
-                               extension='pdf')
-    # launch the sliced wasserstein flow
-    particles = swf(train_particles=train_particles,
-                    test_particles=test_particles,
-                    sketcher=sketcher,
-                    projector_modules=projectors,
-                    stepsize=args.stepsize,
-                    regularization=args.regularization,
-                    num_epochs=args.num_epochs,
-                    device_str=device_str,
-                    plot_function=plotter.log
-                    )
+    # get the particles of the checkpoint
+    if state is not None:
+        train_particles = state['particles']['train']
+        test_particles = state['particles'].get('test', None)
+
+    # the projection matrices, materialized once
+    projectors = projection.ProjectorRegistry(
+        projector_modules, device=device, cache_size=args.num_sketches,
+        dtype=getattr(torch, args.precision))
+
+    plot_kwargs = dict(features=min(train_particles.shape[-1],
+                                    args.plot_num_features),
+                       dataset=train_data,
+                       plot_dir=args.plot_dir,
+                       no_density_plot=args.no_density_plot,
+                       no_particles_plot=args.no_particles_plot,
+                       no_closest_plot=args.no_closest_plot,
+                       no_swcost_plot=args.no_swcost_plot,
+                       swcost_thetas=(
+                        None if args.no_swcost_plot
+                        else projectors.build(projection.HELD_OUT_ID).to(
+                            device='cpu', dtype=torch.float32)),
+                       plot_every=args.plot_every,
+                       plot_epochs=args.plot_epochs,
+                       match_every=args.match_every,
+                       plot_num_train=args.plot_num_train,
+                       plot_num_test=args.plot_num_test,
+                       decode_fn=(
+                        copy.deepcopy(autoencoder.model).to(
+                            'cpu').decode_nograd if args.ae
+                        else None),
+                       make_titles=False,
+                       nn_index_file=os.path.join(
+                        os.path.expanduser(args.nn_index_dir
+                                           or args.plot_dir),
+                        'nn_%s.npy' % sketches.SketchCache.key(**data_params)),
+                       density_cache_file=(
+                        None if args.density_cache_dir is None
+                        else os.path.join(
+                            os.path.expanduser(args.density_cache_dir),
+                            'density_%s.npz'
+                            % sketches.SketchCache.key(
+                                features=args.plot_num_features,
+                                **data_params))),
+                       dpi=300,
+                       basefilename=args.basefilename,
+                       extension='pdf')
+    if args.async_plot:
+        plotter = plotting.AsyncSWFPlot(queue_size=args.plot_queue_size,
+                                        **plot_kwargs)
+    else:
+        plotter = plotting.SWFPlot(**plot_kwargs)
+    checkpointer = (checkpoint.Checkpointer(args.checkpoint,
+                                            every=args.checkpoint_every)
+                    if args.checkpoint is not None else None)
+    profiler = (profiling.Profiler(args.profile, device=device)
+                if args.profile is not None else profiling.NULL_PROFILER)
+    flow_integrator = integration.Integrator(
+        args.stepsize, momentum=args.momentum, nesterov=args.nesterov,
+        adaptive=args.adaptive_stepsize, stepsize_range=args.stepsize_range)
+    early_stopping = integration.EarlyStopping(args.tolerance,
+                                               patience=args.patience)
+    if state is not None and state.get('integrator') is not None:
+        flow_integrator.load_state_dict(state['integrator'], device=device)
+        early_stopping.load_state_dict(state['early_stopping'])
+    if state is not None:
+        checkpoint.restore_rng(state)
+
+    # launch the sliced wasserstein flow. The background writers and
+    # renderers are closed even if it fails, so that they don't keep the
+    # interpreter waiting for them
+    try:
+        particles = swf(train_particles=train_particles,
+                        test_particles=test_particles,
+                        sketcher=sketcher,
+                        projectors=projectors,
+                        stepsize=args.stepsize,
+                        regularization=args.regularization,
+                        num_epochs=args.num_epochs,
+                        device_str=device_str,
+                        plot_function=plotter.log,
+                        fixed_sketches=fixed_sketches,
+                        num_flow_workers=args.num_flow_workers,
+                        dtype=getattr(torch, args.precision),
+                        chunk_size=args.chunk_size,
+                        start_epoch=start_epoch,
+                        checkpoint_function=checkpointer,
+                        profiler=profiler,
+                        integrator=flow_integrator,
+                        early_stopping=early_stopping,
+                        test_loss_schedule=lambda epoch: any(
+                            plotting.log_schedule(epoch, args.plot_every,
+                                                  args.plot_epochs,
+                                                  args.match_every)),
+                        pipelined_sketches=args.pipelined_sketches,
+                        stale_fraction=args.stale_fraction
+                        )
+    finally:
+        profiler.close()
+        if checkpointer is not None:
+            checkpointer.close()
+        if args.async_plot:
+            plotter.close()
     print('''it's time to quit now !!!''')
     import sys
     sys.exit(0)